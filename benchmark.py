@@ -0,0 +1,186 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import statistics
+import time
+
+# Offline load test for main.handler. Replays synthetic webhook updates for
+# all commands against memory_db.MemoryDatabase and fake_telegram.FakeTelegram,
+# so it needs no network, YDB or bot token:
+#   python benchmark.py --updates 5000 --chats 50 --users 20 --db-latency 5
+# With --snapshot the database starts from a snapshot.py export and the
+# updates come from its chats and users.
+
+COMMAND_WEIGHTS = {
+    "/pepper": 5,
+    "/top_peppers": 2,
+    "/pepper_of_the_day": 2,
+    "/ball": 1,
+    "/stats": 1,
+    "/global_top": 1,
+}
+
+
+def make_event(update_id, chat_id, user_id, text):
+    message = {
+        "message_id": update_id,
+        "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": "user{}".format(user_id)},
+        "chat": {"id": chat_id, "title": "chat", "type": "supergroup"},
+        "date": int(time.time()),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"offset": 0, "length": len(text), "type": "bot_command"}]
+    return {
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "X-Trace-Id": "benchmark-{}".format(update_id)},
+        "body": json.dumps({"update_id": update_id, "message": message}),
+    }
+
+
+def make_events(count, chats, users, noise, seed, population=None):
+    # population: (chat_id, user_id) pairs to draw from instead of
+    # synthetic chats and users
+    rng = random.Random(seed)
+    commands = list(COMMAND_WEIGHTS)
+    weights = list(COMMAND_WEIGHTS.values())
+    events = []
+    for update_id in range(1, count + 1):
+        if population:
+            chat_id, user_id = rng.choice(population)
+        else:
+            chat_id = -1000000000000 - rng.randrange(chats)
+            user_id = 1000 + rng.randrange(users)
+        if rng.random() < noise:
+            name, text = "noise", "just chatting"
+        else:
+            name = text = rng.choices(commands, weights)[0]
+        events.append((name, make_event(update_id, chat_id, user_id, text)))
+    return events
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def report(name, latencies, round_trips, messages, elapsed):
+    count = len(latencies)
+    return {
+        "command": name,
+        "updates": count,
+        "throughput": round(count / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "db_calls_per_update": round(round_trips / count, 3),
+        "telegram_calls_per_update": round(messages / count, 3),
+    }
+
+
+def reset_rate_limits(outbox):
+    # full buckets for the next update, as if it came after a pause
+    from outbox import GLOBAL_BURST, GLOBAL_RATE, TokenBucket
+
+    outbox.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+    outbox.chat_buckets.clear()
+
+
+def run(args):
+    from fake_telegram import FakeTelegram
+    from memory_db import MemoryDatabase
+
+    telegram = FakeTelegram(rate_limits=False).start()
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+    os.environ["TELEGRAM_API_URL"] = telegram.api_url
+    import main
+    import repository
+    import tracing
+
+    database = MemoryDatabase(latency=args.db_latency / 1000)
+    if args.snapshot:
+        import snapshot
+
+        for table, rows in snapshot.read_snapshot(args.snapshot):
+            database.load(table, rows)
+    pool = tracing.TracedPool(database)
+    repository.get_pool = lambda: pool
+    main.outbox.get_pool = lambda: pool
+    # don't block on rate limits, count queued messages instead
+    main.outbox.max_wait = 0
+    if not args.rate_limits:
+        # the synthetic updates come far faster than real ones, with the
+        # buckets on most replies would be queued and db_calls_per_update
+        # would mostly count the queue writes
+        reset_rate_limits(main.outbox)
+    if not args.cooldowns:
+        # the synthetic users repeat commands far faster than people do
+        main.guard.cooldowns = {}
+
+    population = sorted(database.peppers) if args.snapshot else None
+    events = make_events(args.updates, args.chats, args.users, args.noise, args.seed, population)
+    by_command = {}
+    devnull = open(os.devnull, "w")
+    started = time.perf_counter()
+    for command, event in events:
+        round_trips = database.round_trips
+        messages = len(telegram.messages)
+        update_started = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            main.handler(event, None)
+        latency = time.perf_counter() - update_started
+        if not args.rate_limits:
+            reset_rate_limits(main.outbox)
+        stats = by_command.setdefault(command, {"latencies": [], "round_trips": 0, "messages": 0})
+        stats["latencies"].append(latency)
+        stats["round_trips"] += database.round_trips - round_trips
+        stats["messages"] += len(telegram.messages) - messages
+    elapsed = time.perf_counter() - started
+    telegram.shutdown()
+
+    # a command's throughput is per second spent handling it
+    rows = [
+        report(command, stats["latencies"], stats["round_trips"], stats["messages"], sum(stats["latencies"]))
+        for command, stats in sorted(by_command.items())
+    ]
+    rows.append(report(
+        "total",
+        [latency for stats in by_command.values() for latency in stats["latencies"]],
+        sum(stats["round_trips"] for stats in by_command.values()),
+        sum(stats["messages"] for stats in by_command.values()),
+        elapsed,
+    ))
+    return {"rows": rows, "queued_messages": len(database.outbox)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the webhook handler")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=30)
+    parser.add_argument("--noise", type=float, default=0.0, help="share of non-command messages")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="milliseconds per DB round-trip")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--snapshot", help="start from a snapshot.py export")
+    parser.add_argument("--cooldowns", action="store_true", help="keep the per-user command cooldowns")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the outbox rate limits, replies over them are queued")
+    parser.add_argument("--json", action="store_true", help="print raw JSON")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+    columns = ["command", "updates", "throughput", "p50_ms", "p95_ms", "p99_ms", "db_calls_per_update", "telegram_calls_per_update"]
+    print(" ".join("{:>20}".format(column) for column in columns))
+    for row in result["rows"]:
+        print(" ".join("{:>20}".format(str(row[column])) for column in columns))
+    print("queued messages: {}".format(result["queued_messages"]))
+
+
+if __name__ == "__main__":
+    main()
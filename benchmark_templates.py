@@ -0,0 +1,87 @@
+import argparse
+import os
+import timeit
+from types import SimpleNamespace
+from templates import LOCALE, render_top
+
+# Micro-benchmark of the reply rendering in templates.py against the
+# str.format code it replaced, which is kept below for comparison:
+#   python benchmark_templates.py --number 100000
+# The outputs are compared first, the old code doesn't escape usernames so
+# the sample usernames are plain.
+
+
+def legacy_pepper_message(username, size, place, grow_size=0, is_repeat=False, bonus=None):
+    first_line = """@{}, твой перчик """.format(username)
+    if is_repeat:
+        first_line = """@{}, ты уже измерял перчик сегодня.\n""".format(username)
+    else:
+        if grow_size > 0:
+            first_line += "вырос на <b>{} см</b>.\n".format(grow_size)
+            if bonus:
+                if bonus["type"] == "double_increase":
+                    first_line += "🍀 А еще ты получаешь бонус с двойным ростом и твой перчик сегодня вырастает на <b>{} см</b>!\n".format(
+                        bonus["size"]
+                    )
+                if bonus["type"] == "curse_of_the_first":
+                    first_line += '👑 Но из-за "Проклятия первого" рост твоего перчика сегодня уменьшается вдвое до <b>{} см</b>.\n'.format(
+                        bonus["size"]
+                    )
+        elif grow_size == 0:
+            first_line += "не изменился.\n"
+        else:
+            first_line += "уменьшился на <b>{} см</b>.\n".format(abs(grow_size))
+    second_line = """{0} он равен <b>{1} см</b>.\n""".format(
+        "Сейчас" if is_repeat else "Теперь", size
+    )
+    third_line = """Ты занимаешь <b>{} место</b> в топе.\n""".format(place)
+    fourth_line = """Следующая попытка завтра!"""
+    return first_line + second_line + third_line + fourth_line
+
+
+def legacy_top_peppers(top_peppers):
+    text = "Топ 10 перчиков:\n"
+    for index, pepper in enumerate(top_peppers, start=1):
+        text += "\n{0}| <b>{1}</b> — <b>{2} см</b>".format(
+            index, pepper.username, pepper.size
+        )
+    return text
+
+
+CASES = {
+    "grow": dict(username="user1", size=120, place=3, grow_size=7),
+    "double_increase": dict(
+        username="user1", size=120, place=3, grow_size=7, bonus={"type": "double_increase", "size": 14}
+    ),
+    "curse_of_the_first": dict(
+        username="user1", size=120, place=1, grow_size=7, bonus={"type": "curse_of_the_first", "size": 4}
+    ),
+    "repeat": dict(username="user1", size=120, place=3, is_repeat=True),
+}
+TOP = [SimpleNamespace(username="user{}".format(i), size=200 - i) for i in range(10)]
+
+
+def run(number):
+    os.environ.setdefault("TELEGRAM_TOKEN", "0:benchmark")
+    from main import create_pepper_message as pepper_message
+
+    if LOCALE == "ru":
+        for case in CASES.values():
+            assert pepper_message(**case) == legacy_pepper_message(**case), case
+        assert render_top("top_peppers", TOP) == legacy_top_peppers(TOP)
+    benchmarks = [
+        ("pepper_" + name, lambda case=case: legacy_pepper_message(**case), lambda case=case: pepper_message(**case))
+        for name, case in CASES.items()
+    ]
+    benchmarks.append(("top_peppers", lambda: legacy_top_peppers(TOP), lambda: render_top("top_peppers", TOP)))
+    print("{:<28} {:>10} {:>10} {:>8}".format("message", "old, us", "new, us", "ratio"))
+    for name, old, new in benchmarks:
+        old_time = min(timeit.repeat(old, number=number, repeat=3)) / number * 1e6
+        new_time = min(timeit.repeat(new, number=number, repeat=3)) / number * 1e6
+        print("{:<28} {:>10.2f} {:>10.2f} {:>8.2f}".format(name, old_time, new_time, old_time / new_time))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000, help="calls per measurement")
+    run(parser.parse_args().number)
@@ -1,4 +1,7 @@
+import json
 import os
+import sys
+import time
 import ydb
 import ydb.iam
 from dotenv import load_dotenv
@@ -16,28 +19,555 @@ load_dotenv()
 # # Create the session pool instance to manage YDB sessions.
 # pool = ydb.SessionPool(driver)
 
-def create_tables(pool):
+# Peppers are keyed by (chat_id, user_id), so every lookup on the hot path is
+# a point read and YDB can split the table by chat.
+def create_peppers_table(session, name):
+    session.execute_scheme(
+        """
+            CREATE table `{}` (
+                `chat_id` Int64,
+                `user_id` Int64,
+                `pepper_id` Utf8,
+                `username` Utf8,
+                `size` Int64,
+                `last_updated` Int64,
+                `day` Int64,
+                PRIMARY KEY (`chat_id`, `user_id`),
+                INDEX `idx_chat_size` GLOBAL ON (`chat_id`, `size`) COVER (`username`)
+            )
+            WITH (
+                AUTO_PARTITIONING_BY_SIZE = ENABLED,
+                AUTO_PARTITIONING_BY_LOAD = ENABLED
+            )
+            """.format(name)
+    )
+
+def create_outbox_table(session):
+    session.execute_scheme(
+        """
+            CREATE table `outbox` (
+                `created_at` Int64,
+                `message_id` Utf8,
+                `chat_id` Int64,
+                `text` Utf8,
+                `parse_mode` Utf8,
+                `disable_notification` Bool,
+                `next_attempt` Int64,
+                PRIMARY KEY (`created_at`, `message_id`)
+            )
+            """
+    )
+
+# Dense 0..participants-1 numbering of the peppers in every chat, so a
+# random draw is one point read (see queries.GET_RANDOM_PEPPER).
+def create_participants_tables(session):
+    session.execute_scheme(
+        """
+            CREATE table `chats` (
+                `chat_id` Int64,
+                `participants` Uint64,
+                `grows` Int64,
+                `total_growth` Int64,
+                `timezone` Utf8,
+                PRIMARY KEY (`chat_id`),
+                INDEX `idx_timezone` GLOBAL ON (`timezone`, `chat_id`)
+            )
+            """
+    )
+    session.execute_scheme(
+        """
+            CREATE table `chat_participants` (
+                `chat_id` Int64,
+                `seq` Uint64,
+                `user_id` Int64,
+                PRIMARY KEY (`chat_id`, `seq`)
+            )
+            WITH (
+                AUTO_PARTITIONING_BY_SIZE = ENABLED,
+                AUTO_PARTITIONING_BY_LOAD = ENABLED
+            )
+            """
+    )
+
+# Grow history and the running totals /stats reads, the per-chat totals
+# live in `chats` (see queries.RECORD_GROWTH). `bonuses` is a JSON object
+# of the times each bonus type applied.
+def create_stats_tables(session):
+    session.execute_scheme(
+        """
+            CREATE table `pepper_events` (
+                `chat_id` Int64,
+                `user_id` Int64,
+                `created_at` Int64,
+                `grow` Int64,
+                `bonus` Utf8,
+                `size` Int64,
+                PRIMARY KEY (`chat_id`, `user_id`, `created_at`)
+            )
+            WITH (
+                AUTO_PARTITIONING_BY_SIZE = ENABLED,
+                AUTO_PARTITIONING_BY_LOAD = ENABLED
+            )
+            """
+    )
+    session.execute_scheme(
+        """
+            CREATE table `pepper_stats` (
+                `chat_id` Int64,
+                `user_id` Int64,
+                `grows` Int64,
+                `total_growth` Int64,
+                `streak` Int64,
+                `best_streak` Int64,
+                `last_day` Int64,
+                `bonuses` Utf8,
+                PRIMARY KEY (`chat_id`, `user_id`)
+            )
+            WITH (
+                AUTO_PARTITIONING_BY_SIZE = ENABLED,
+                AUTO_PARTITIONING_BY_LOAD = ENABLED
+            )
+            """
+    )
+
+# The current pepper of the day of every chat, drawn by peppers_of_the_day.py.
+def create_peppers_of_the_day_table(session):
+    session.execute_scheme(
+        """
+            CREATE table `peppers_of_the_day` (
+                `chat_id` Int64,
+                `user_id` Int64,
+                `last_updated` Int64,
+                `day` Int64,
+                PRIMARY KEY (`chat_id`)
+            )
+            WITH (
+                AUTO_PARTITIONING_BY_SIZE = ENABLED,
+                AUTO_PARTITIONING_BY_LOAD = ENABLED
+            )
+            """
+    )
+
+# The biggest peppers of all chats, see queries.GET_GLOBAL_TOP.
+def create_global_top_table(session):
+    session.execute_scheme(
+        """
+            CREATE table `global_top` (
+                `chat_id` Int64,
+                `user_id` Int64,
+                `username` Utf8,
+                `size` Int64,
+                PRIMARY KEY (`chat_id`, `user_id`)
+            )
+            """
+    )
+
+def create_tables(driver, pool):
+    def callee(session):
+        create_peppers_table(session, "peppers")
+        create_peppers_of_the_day_table(session)
+        create_outbox_table(session)
+        create_participants_tables(session)
+        create_stats_tables(session)
+        create_global_top_table(session)
+    return pool.retry_operation_sync(callee)
+
+def create_outbox(driver, pool):
+    return pool.retry_operation_sync(create_outbox_table)
+
+# Leaderboard index for tables created before it was part of the schema.
+# YDB builds the index online and backfills it from the existing rows.
+def add_leaderboard_index(driver, pool):
     def callee(session):
         session.execute_scheme(
             """
-                CREATE table `peppers` (
-                    `pepper_id` Utf8,
-                    `chat_id` Int64,
-                    `user_id` Int64,
-                    `username` Utf8,
-                    `size` Int64,
-                    `last_updated` Int64,
-                    PRIMARY KEY (`pepper_id`)
-                )
+                ALTER TABLE `peppers`
+                ADD INDEX `idx_chat_size` GLOBAL ON (`chat_id`, `size`) COVER (`user_id`, `username`)
                 """
         )
     return pool.retry_operation_sync(callee)
 
-def run():
+# Online migration of the old `peppers` table (keyed by pepper_id) to the
+# (chat_id, user_id) schema:
+#   python create_table.py migrate_peppers  -- copy rows into `peppers_v2`
+#   python create_table.py swap_peppers     -- catch up, verify and rename
+# migrate_peppers can be interrupted and rerun, it resumes from the last
+# copied key stored in MIGRATION_CHECKPOINT. The bot keeps writing to the
+# old table until the swap, rows it touches meanwhile are copied again by
+# the catch-up pass. Rows it writes between the last catch-up and the
+# rename are merged from `peppers_v1` right after the rename.
+MIGRATION_CHECKPOINT = ".migrate_peppers.json"
+MIGRATION_BATCH_SIZE = 1000
+PEPPERS_COLUMNS = (
+    ydb.BulkUpsertColumns()
+    .add_column("chat_id", ydb.OptionalType(ydb.PrimitiveType.Int64))
+    .add_column("user_id", ydb.OptionalType(ydb.PrimitiveType.Int64))
+    .add_column("pepper_id", ydb.OptionalType(ydb.PrimitiveType.Utf8))
+    .add_column("username", ydb.OptionalType(ydb.PrimitiveType.Utf8))
+    .add_column("size", ydb.OptionalType(ydb.PrimitiveType.Int64))
+    .add_column("last_updated", ydb.OptionalType(ydb.PrimitiveType.Int64))
+)
+PEPPERS_COLUMN_NAMES = ("chat_id", "user_id", "pepper_id", "username", "size", "last_updated")
+PEPPER_ID_KEY = ydb.TupleType().add_element(ydb.OptionalType(ydb.PrimitiveType.Utf8))
+
+def table_path(name):
+    return "{}/{}".format(os.getenv("YDB_DATABASE"), name)
+
+def load_checkpoint():
+    if not os.path.exists(MIGRATION_CHECKPOINT):
+        return {"last_key": None, "copied": False, "since": None}
+    with open(MIGRATION_CHECKPOINT) as f:
+        return json.load(f)
+
+def save_checkpoint(checkpoint):
+    with open(MIGRATION_CHECKPOINT, "w") as f:
+        json.dump(checkpoint, f)
+
+def bulk_upsert_peppers(driver, rows):
+    driver.table_client.bulk_upsert(
+        table_path("peppers_v2"),
+        [{column: row[column] for column in PEPPERS_COLUMN_NAMES} for row in rows],
+        PEPPERS_COLUMNS,
+    )
+
+def scan(driver, query, parameters=None, parameter_types=None):
+    iterator = driver.table_client.scan_query(
+        ydb.ScanQuery(query, parameter_types or {}), parameters
+    )
+    for response in iterator:
+        for row in response.result_set.rows:
+            yield row
+
+def copy_peppers(driver, pool, checkpoint):
+    def callee(session):
+        try:
+            session.describe_table(table_path("peppers_v2"))
+        except ydb.SchemeError:
+            create_peppers_table(session, "peppers_v2")
+    pool.retry_operation_sync(callee)
+
+    key_range = None
+    if checkpoint["last_key"] is not None:
+        key_range = ydb.KeyRange(
+            ydb.KeyBound.exclusive((checkpoint["last_key"],), PEPPER_ID_KEY), None
+        )
+    batch = []
+    with pool.checkout() as session:
+        for result_set in session.read_table(table_path("peppers"), key_range, ordered=True):
+            batch.extend(result_set.rows)
+            while len(batch) >= MIGRATION_BATCH_SIZE:
+                rows, batch = batch[:MIGRATION_BATCH_SIZE], batch[MIGRATION_BATCH_SIZE:]
+                bulk_upsert_peppers(driver, rows)
+                checkpoint["last_key"] = rows[-1].pepper_id
+                save_checkpoint(checkpoint)
+                print("copied up to {}".format(checkpoint["last_key"]))
+    if batch:
+        bulk_upsert_peppers(driver, batch)
+        checkpoint["last_key"] = batch[-1].pepper_id
+    checkpoint["copied"] = True
+    save_checkpoint(checkpoint)
+
+# Copies rows the bot updated since the previous pass.
+def catch_up_peppers(driver, checkpoint):
+    since = checkpoint["since"]
+    checkpoint["since"] = int(time.time())
+    rows = list(scan(
+        driver,
+        "DECLARE $since AS Int64; SELECT * FROM `peppers` WHERE last_updated >= $since;",
+        {"$since": since},
+        {"$since": ydb.PrimitiveType.Int64},
+    ))
+    for i in range(0, len(rows), MIGRATION_BATCH_SIZE):
+        bulk_upsert_peppers(driver, rows[i:i + MIGRATION_BATCH_SIZE])
+    save_checkpoint(checkpoint)
+    print("caught up {} rows".format(len(rows)))
+
+def verify_peppers(driver):
+    # The old table may hold duplicate rows for the same user, the new key
+    # folds them into one.
+    expected = next(scan(
+        driver,
+        "SELECT COUNT(*) AS count FROM (SELECT DISTINCT chat_id, user_id FROM `peppers`);",
+    )).count
+    actual = next(scan(driver, "SELECT COUNT(*) AS count FROM `peppers_v2`;")).count
+    print("peppers: {} users, peppers_v2: {} rows".format(expected, actual))
+    return expected == actual
+
+def migrate_peppers(driver, pool):
+    checkpoint = load_checkpoint()
+    if checkpoint["since"] is None:
+        checkpoint["since"] = int(time.time())
+    if not checkpoint["copied"]:
+        copy_peppers(driver, pool, checkpoint)
+    catch_up_peppers(driver, checkpoint)
+    if not verify_peppers(driver):
+        sys.exit("row counts differ, rerun migrate_peppers")
+
+def swap_peppers(driver, pool):
+    checkpoint = load_checkpoint()
+    if not checkpoint["copied"]:
+        sys.exit("run migrate_peppers first")
+    catch_up_peppers(driver, checkpoint)
+    if not verify_peppers(driver):
+        sys.exit("row counts differ, rerun migrate_peppers")
+
+    def callee(session):
+        session.rename_tables([
+            ydb.RenameItem(table_path("peppers"), table_path("peppers_v1")),
+            ydb.RenameItem(table_path("peppers_v2"), table_path("peppers")),
+        ])
+    pool.retry_operation_sync(callee)
+    print("peppers_v2 is now peppers, the old table is kept as peppers_v1")
+    merge_late_peppers(driver, pool, checkpoint)
+
+# Rows of the old table written since the last catch-up. The bot already
+# writes to the new table, so a row is only taken if it is newer than the
+# one there.
+MERGE_PEPPERS = """
+DECLARE $rows AS List<Struct<
+    chat_id: Int64?,
+    user_id: Int64?,
+    pepper_id: Utf8?,
+    username: Utf8?,
+    size: Int64?,
+    last_updated: Int64?
+>>;
+
+UPSERT INTO `peppers`
+SELECT r.chat_id AS chat_id, r.user_id AS user_id, r.pepper_id AS pepper_id,
+    r.username AS username, r.size AS size, r.last_updated AS last_updated
+FROM AS_TABLE($rows) AS r
+LEFT JOIN `peppers` AS p ON p.chat_id = r.chat_id AND p.user_id = r.user_id
+WHERE p.last_updated IS NULL OR p.last_updated < r.last_updated;
+"""
+
+def merge_late_peppers(driver, pool, checkpoint):
+    rows = list(scan(
+        driver,
+        "DECLARE $since AS Int64; SELECT * FROM `peppers_v1` WHERE last_updated >= $since;",
+        {"$since": checkpoint["since"]},
+        {"$since": ydb.PrimitiveType.Int64},
+    ))
+    for i in range(0, len(rows), MIGRATION_BATCH_SIZE):
+        batch = [{column: row[column] for column in PEPPERS_COLUMN_NAMES} for row in rows[i:i + MIGRATION_BATCH_SIZE]]
+
+        def callee(session):
+            session.transaction(ydb.SerializableReadWrite()).execute(
+                session.prepare(MERGE_PEPPERS), {"$rows": batch}, commit_tx=True
+            )
+        pool.retry_operation_sync(callee)
+    print("merged {} rows written during the swap".format(len(rows)))
+
+# Numbers the peppers that are not in `chat_participants` yet, i.e. all of
+# them on the first run. Each chat is indexed in a transaction of its own
+# that appends the missing peppers with queries.ADD_PARTICIPANTS, the same
+# statement the bot uses, so it is safe to run next to the bot. Until a
+# chat is indexed its draws find nobody, so run it before deploying the
+# bot that draws from the index, then once more after the deploy for the
+# peppers created in between. Rerunning only appends what is missing.
+MISSING_PARTICIPANTS = """
+DECLARE $chat_id AS Int64;
+DECLARE $limit AS Uint64;
+
+SELECT p.user_id AS user_id
+FROM (SELECT user_id FROM `peppers` WHERE chat_id = $chat_id) AS p
+LEFT ONLY JOIN (SELECT user_id FROM `chat_participants` WHERE chat_id = $chat_id) AS m
+ON m.user_id = p.user_id
+ORDER BY user_id
+LIMIT $limit;
+"""
+
+def index_participants(driver, pool):
+    import queries
+
+    def callee(session):
+        try:
+            session.describe_table(table_path("chats"))
+        except ydb.SchemeError:
+            create_participants_tables(session)
+    pool.retry_operation_sync(callee)
+
+    def index_chat(session, chat_id):
+        # a page of the missing peppers, the number of them indexed
+        tx = session.transaction(ydb.SerializableReadWrite())
+        user_ids = [
+            row.user_id
+            for row in tx.execute(
+                session.prepare(MISSING_PARTICIPANTS),
+                {"$chat_id": chat_id, "$limit": MIGRATION_BATCH_SIZE},
+            )[0].rows
+        ]
+        if not user_ids:
+            tx.commit()
+            return 0
+        tx.execute(
+            session.prepare(queries.ADD_PARTICIPANTS),
+            {"$chat_id": chat_id, "$user_ids": user_ids},
+            commit_tx=True,
+        )
+        return len(user_ids)
+
+    chats = 0
+    for row in scan(driver, "SELECT DISTINCT chat_id FROM `peppers`;"):
+        while pool.retry_operation_sync(index_chat, row.chat_id) == MIGRATION_BATCH_SIZE:
+            pass
+        chats += 1
+    print("indexed {} chats".format(chats))
+
+# Statistics for databases created before them. A pepper's size is the net
+# growth of all its grows, so it is the pepper's total_growth and the chat
+# total is the sum of the sizes. How many grows that took is unknown: the
+# users' counts and streaks start at 0 and the chat's grows stay NULL, so
+# /stats shows no average growth per measurement for such chats (see
+# repository.chat_grows). Chats that already have a total_growth are
+# skipped: the bot counted their grows, or an earlier run backfilled them.
+# Each chat is checked and backfilled in one transaction, so it is safe to
+# run next to the bot and to rerun.
+CHAT_TOTAL_GROWTH = """
+DECLARE $chat_id AS Int64;
+
+SELECT total_growth FROM `chats` WHERE chat_id = $chat_id;
+"""
+
+BACKFILL_STATS = """
+DECLARE $chat_id AS Int64;
+
+$peppers = (SELECT user_id, size FROM `peppers` WHERE chat_id = $chat_id);
+
+UPSERT INTO `pepper_stats`
+SELECT
+    $chat_id AS chat_id,
+    p.user_id AS user_id,
+    s.grows ?? 0 AS grows,
+    p.size ?? 0 AS total_growth,
+    s.streak ?? 0 AS streak,
+    s.best_streak ?? 0 AS best_streak,
+    s.last_day ?? 0 AS last_day
+FROM $peppers AS p
+LEFT JOIN (SELECT * FROM `pepper_stats` WHERE chat_id = $chat_id) AS s ON s.user_id = p.user_id;
+
+UPSERT INTO `chats` (chat_id, grows, total_growth)
+SELECT $chat_id AS chat_id, CAST(NULL AS Int64) AS grows, SUM(size ?? 0) AS total_growth
+FROM $peppers;
+"""
+
+def add_stats(driver, pool):
+    def callee(session):
+        try:
+            session.describe_table(table_path("pepper_stats"))
+        except ydb.SchemeError:
+            create_stats_tables(session)
+            session.execute_scheme(
+                """
+                    ALTER TABLE `chats`
+                    ADD COLUMN `grows` Int64,
+                    ADD COLUMN `total_growth` Int64
+                    """
+            )
+    pool.retry_operation_sync(callee)
+
+    def backfill_chat(session, chat_id):
+        tx = session.transaction(ydb.SerializableReadWrite())
+        chat = tx.execute(session.prepare(CHAT_TOTAL_GROWTH), {"$chat_id": chat_id})[0].rows
+        if chat and chat[0].total_growth is not None:
+            tx.commit()
+            return False
+        tx.execute(session.prepare(BACKFILL_STATS), {"$chat_id": chat_id}, commit_tx=True)
+        return True
+
+    chats = skipped = 0
+    for row in scan(driver, "SELECT DISTINCT chat_id FROM `peppers`;"):
+        if pool.retry_operation_sync(backfill_chat, row.chat_id):
+            chats += 1
+        else:
+            skipped += 1
+    print("stats for {} chats, {} already had them".format(chats, skipped))
+
+# Fills `global_top` from `peppers` with one sort over the whole table,
+# for databases created before it. Rerunning it is safe.
+GLOBAL_TOP_SIZE = 100
+GLOBAL_TOP_COLUMNS = (
+    ydb.BulkUpsertColumns()
+    .add_column("chat_id", ydb.OptionalType(ydb.PrimitiveType.Int64))
+    .add_column("user_id", ydb.OptionalType(ydb.PrimitiveType.Int64))
+    .add_column("username", ydb.OptionalType(ydb.PrimitiveType.Utf8))
+    .add_column("size", ydb.OptionalType(ydb.PrimitiveType.Int64))
+)
+
+def build_global_top(driver, pool):
+    def callee(session):
+        try:
+            session.describe_table(table_path("global_top"))
+        except ydb.SchemeError:
+            create_global_top_table(session)
+    pool.retry_operation_sync(callee)
+
+    rows = [
+        {"chat_id": row.chat_id, "user_id": row.user_id, "username": row.username, "size": row.size}
+        for row in scan(
+            driver,
+            "SELECT chat_id, user_id, username, size FROM `peppers` ORDER BY size DESC LIMIT {};".format(GLOBAL_TOP_SIZE),
+        )
+    ]
+    driver.table_client.bulk_upsert(table_path("global_top"), rows, GLOBAL_TOP_COLUMNS)
+    print("global top of {} peppers".format(len(rows)))
+
+# Day columns and chat timezones for databases created before them. Rows
+# without a day fall back to their last_updated (see repository.day_of), so
+# nothing is backfilled. Databases that never had `peppers_of_the_day`
+# get it with the day column.
+def add_timezones(driver, pool):
+    def callee(session):
+        session.execute_scheme("ALTER TABLE `peppers` ADD COLUMN `day` Int64")
+        try:
+            session.describe_table(table_path("peppers_of_the_day"))
+        except ydb.SchemeError:
+            create_peppers_of_the_day_table(session)
+        else:
+            session.execute_scheme("ALTER TABLE `peppers_of_the_day` ADD COLUMN `day` Int64")
+        session.execute_scheme(
+            """
+                ALTER TABLE `chats`
+                ADD COLUMN `timezone` Utf8
+                """
+        )
+        session.execute_scheme(
+            """
+                ALTER TABLE `chats`
+                ADD INDEX `idx_timezone` GLOBAL ON (`timezone`, `chat_id`)
+                """
+        )
+    return pool.retry_operation_sync(callee)
+
+# Bonus counts keyed by type, for databases that have a column per bonus
+# type in `pepper_stats`. Rows without `bonuses` fall back to those columns
+# (see repository.bonus_counts) until their next grow, so nothing is
+# backfilled.
+def add_bonus_stats(driver, pool):
+    def callee(session):
+        session.execute_scheme("ALTER TABLE `pepper_stats` ADD COLUMN `bonuses` Utf8")
+    return pool.retry_operation_sync(callee)
+
+COMMANDS = {
+    "create_tables": create_tables,
+    "add_leaderboard_index": add_leaderboard_index,
+    "create_outbox": create_outbox,
+    "migrate_peppers": migrate_peppers,
+    "swap_peppers": swap_peppers,
+    "index_participants": index_participants,
+    "add_stats": add_stats,
+    "build_global_top": build_global_top,
+    "add_timezones": add_timezones,
+    "add_bonus_stats": add_bonus_stats,
+}
+
+def run(command):
     with ydb.Driver(endpoint=os.getenv("YDB_ENDPOINT"), database=os.getenv("YDB_DATABASE"), credentials=ydb.iam.ServiceAccountCredentials.from_file(os.getenv("SA_KEY_FILE"))) as driver:
         driver.wait(timeout=5, fail_fast=True)
 
         with ydb.SessionPool(driver) as pool:
 
-            create_tables(pool)
-run()
\ No newline at end of file
+            COMMANDS[command](driver, pool)
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else "create_tables")
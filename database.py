@@ -0,0 +1,118 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import tracing
+
+logger = logging.getLogger("database")
+
+# The YDB driver and session pool are created on first use, so updates that
+# never touch the database don't pay for the ydb import, the IAM token fetch
+# and endpoint discovery.
+_pool = None
+_lock = threading.Lock()
+_async_pool = None
+_async_lock = None
+# Cold start breakdown in seconds, filled in by the entry points and by
+# get_pool().
+startup_timings = {}
+# Pool settings, tunable per deployment. YDB_POOL_SIZE caps the sessions
+# of one process, YDB_WARM_SESSIONS are created with the pool so the first
+# queries don't wait for CreateSession. The timeouts apply to every data
+# query (queries.settings): QUERY_TIMEOUT is the client deadline,
+# OPERATION_TIMEOUT the server side one.
+POOL_SIZE = int(os.getenv("YDB_POOL_SIZE", "50"))
+WARM_SESSIONS = int(os.getenv("YDB_WARM_SESSIONS", "1"))
+QUERY_TIMEOUT = float(os.getenv("YDB_QUERY_TIMEOUT", "3"))
+OPERATION_TIMEOUT = float(os.getenv("YDB_OPERATION_TIMEOUT", "2"))
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = _create_pool()
+    return _pool
+
+
+def _create_pool():
+    started = time.perf_counter()
+    import ydb
+    import ydb.iam
+
+    imported = time.perf_counter()
+    credentials = (
+        ydb.iam.ServiceAccountCredentials.from_file(os.getenv("SA_KEY_FILE"))
+        if os.getenv("LAMBDA_RUNTIME_DIR") is None
+        else ydb.iam.MetadataUrlCredentials()
+    )
+    # fetch the IAM token now, so it is measured apart from discovery
+    credentials.auth_metadata()
+    authenticated = time.perf_counter()
+    driver = ydb.Driver(
+        endpoint=os.getenv("YDB_ENDPOINT"),
+        database=os.getenv("YDB_DATABASE"),
+        credentials=credentials,
+    )
+    # Wait for the driver to become active for requests.
+    driver.wait(fail_fast=True, timeout=5)
+    discovered = time.perf_counter()
+    # Create the session pool instance to manage YDB sessions.
+    pool = tracing.TracedPool(
+        ydb.SessionPool(driver, size=POOL_SIZE, min_pool_size=WARM_SESSIONS)
+    )
+
+    startup_timings.update(
+        ydb_import=round(imported - started, 4),
+        credentials=round(authenticated - imported, 4),
+        discovery=round(discovered - authenticated, 4),
+    )
+    logger.info("YDB startup %s", json.dumps(startup_timings))
+    return pool
+
+
+# asyncio counterpart of get_pool() for main_async.py, bound to the running
+# event loop.
+async def get_async_pool():
+    global _async_pool, _async_lock
+    if _async_pool is None:
+        if _async_lock is None:
+            _async_lock = asyncio.Lock()
+        async with _async_lock:
+            if _async_pool is None:
+                _async_pool = await _create_async_pool()
+    return _async_pool
+
+
+async def _create_async_pool():
+    started = time.perf_counter()
+    import ydb
+    import ydb.aio
+    import ydb.aio.iam
+
+    imported = time.perf_counter()
+    credentials = (
+        ydb.aio.iam.ServiceAccountCredentials.from_file(os.getenv("SA_KEY_FILE"))
+        if os.getenv("LAMBDA_RUNTIME_DIR") is None
+        else ydb.aio.iam.MetadataUrlCredentials()
+    )
+    driver = ydb.aio.Driver(
+        endpoint=os.getenv("YDB_ENDPOINT"),
+        database=os.getenv("YDB_DATABASE"),
+        credentials=credentials,
+    )
+    await driver.wait(fail_fast=True, timeout=5)
+    discovered = time.perf_counter()
+    pool = tracing.TracedPool(
+        ydb.aio.SessionPool(driver, size=POOL_SIZE, min_pool_size=WARM_SESSIONS)
+    )
+
+    startup_timings.update(
+        ydb_import=round(imported - started, 4),
+        discovery=round(discovered - imported, 4),
+    )
+    logger.info("YDB async startup %s", json.dumps(startup_timings))
+    return pool
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Local stand-in for api.telegram.org that enforces the same rate limits
+# and answers 429 with retry_after. Point the bot at it with
+#   TELEGRAM_API_URL=http://127.0.0.1:8081/bot{0}/{1}
+# and run it with `python fake_telegram.py`.
+
+GLOBAL_LIMIT = 30  # messages per second
+GROUP_LIMIT = 20  # messages per minute in a group
+
+
+class FakeTelegram(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), rate_limits=True):
+        super().__init__(address, FakeTelegramHandler)
+        self.rate_limits = rate_limits
+        self.lock = threading.Lock()
+        self.messages = []
+        self.rejected = 0
+        self.sent_at = deque()
+        self.chat_sent_at = defaultdict(deque)
+        self.message_id = 0
+
+    @property
+    def api_url(self):
+        return "http://{}:{}/bot{{0}}/{{1}}".format(*self.server_address[:2])
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def retry_after(self, chat_id):
+        # seconds the caller has to wait, 0 if the message may be sent now
+        now = time.monotonic()
+        while self.sent_at and now - self.sent_at[0] >= 1:
+            self.sent_at.popleft()
+        chat_sent_at = self.chat_sent_at[chat_id]
+        while chat_sent_at and now - chat_sent_at[0] >= 60:
+            chat_sent_at.popleft()
+        if len(self.sent_at) >= GLOBAL_LIMIT:
+            return 1
+        if chat_id < 0 and len(chat_sent_at) >= GROUP_LIMIT:
+            return int(60 - (now - chat_sent_at[0])) + 1
+        return 0
+
+    def send_message(self, params):
+        chat_id = int(params["chat_id"])
+        with self.lock:
+            retry_after = self.retry_after(chat_id) if self.rate_limits else 0
+            if retry_after:
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after {}".format(retry_after),
+                    "parameters": {"retry_after": retry_after},
+                }
+            now = time.monotonic()
+            self.sent_at.append(now)
+            self.chat_sent_at[chat_id].append(now)
+            self.message_id += 1
+            self.messages.append(params)
+            return 200, {
+                "ok": True,
+                "result": {
+                    "message_id": self.message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                    "text": params.get("text", ""),
+                },
+            }
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+        # telebot sends the parameters in the query string
+        path, _, query = self.path.partition("?")
+        params.update({key: values[0] for key, values in parse_qs(query).items()})
+        method = path.rsplit("/", 1)[-1]
+        if method == "sendMessage":
+            status, response = self.server.send_message(params)
+        else:
+            status, response = 200, {"ok": True, "result": True}
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    server = FakeTelegram(("127.0.0.1", 8081))
+    print("Fake Telegram API on {}".format(server.api_url))
+    server.serve_forever()
@@ -0,0 +1,62 @@
+from cache import TTLCache
+
+# Telegram redelivers an update until the webhook answers, so a slow
+# invocation can see the same update again.
+UPDATE_TTL = 3600
+# Seconds a user has to wait before the same command works again in a chat.
+COOLDOWNS = {
+    "pepper": 5,
+    "top_peppers": 5,
+    "pepper_of_the_day": 5,
+    "ball": 10,
+    "stats": 5,
+    "global_top": 5,
+    "timezone": 5,
+}
+
+
+class Guard:
+    # Checks in front of the command handlers that need no database: drops
+    # updates that were already handled and commands repeated within their
+    # cooldown, and remembers who already grew their pepper today so the
+    # repeat answer comes from memory. Like the other caches it is per
+    # container, a retry that lands on another instance is handled again.
+    def __init__(self, cooldowns=COOLDOWNS):
+        self.cooldowns = cooldowns
+        self.updates = TTLCache(maxsize=10000, ttl=UPDATE_TTL)
+        self.last_used = TTLCache(maxsize=10000, ttl=max(cooldowns.values()))
+        self.grown = TTLCache(maxsize=100000, ttl=24 * 3600)
+
+    def admit(self, update, command):
+        # The update is marked as seen right away, so a redelivery that
+        # comes while it is still handled is dropped. Call forget() if the
+        # handling fails.
+        update_id = update.get("update_id")
+        if update_id is not None:
+            if self.updates.get(update_id):
+                return False
+            self.updates.set(update_id, True)
+        cooldown = self.cooldowns.get(command)
+        if cooldown:
+            message = update["message"]
+            key = (message["chat"]["id"], message.get("from", {}).get("id"), command)
+            if self.last_used.get(key):
+                return False
+            self.last_used.set(key, True, ttl=cooldown)
+        return True
+
+    def forget(self, update, command):
+        # Undoes admit() for an update whose handler failed, so Telegram's
+        # redelivery of it is handled instead of dropped as a duplicate or
+        # by the cooldown.
+        self.updates.invalidate(update.get("update_id"))
+        message = update["message"]
+        self.last_used.invalidate((message["chat"]["id"], message.get("from", {}).get("id"), command))
+
+    # Result of today's grow, kept until midnight. The place in it is the
+    # one at the time of the grow.
+    def grown_today(self, chat_id, user_id):
+        return self.grown.get((chat_id, user_id))
+
+    def remember_grown(self, chat_id, user_id, result, ttl):
+        self.grown.set((chat_id, user_id), result, ttl=ttl)
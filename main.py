@@ -1,41 +1,102 @@
+import time
+
+import_started = time.perf_counter()
 import logging
 import telebot
 import json
 import os
-import ydb
-import ydb.iam
-from datetime import datetime
-from random import randrange
-import uuid
 from dotenv import load_dotenv
-import math
+from database import get_pool, startup_timings
+from guard import Guard
+from repository import (
+    bonus_counts,
+    create_pepper_of_the_day,
+    day_of,
+    get_global_top,
+    get_pepper,
+    get_pepper_of_the_day,
+    get_random_pepper,
+    get_stats,
+    get_top_peppers,
+    grow_pepper_transaction,
+    seconds_until_midnight,
+    set_chat_timezone,
+    timezone_name,
+    today,
+    update_pepper_of_the_day,
+    valid_timezone,
+)
+import tracing
+from outbox import Outbox
+from rng import ball_stream
+from rules import RULES
+from templates import BALL_RESPONSES, TEMPLATES, render, render_many, render_top
 
 # init
 load_dotenv()
 logger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
+if os.getenv("TELEGRAM_API_URL"):
+    # e.g. fake_telegram.py for local runs
+    telebot.apihelper.API_URL = os.getenv("TELEGRAM_API_URL")
 bot = telebot.TeleBot(os.getenv("TELEGRAM_TOKEN"), threaded=False, parse_mode="HTML")
-
-# Create driver in global space.
-driver = ydb.Driver(
-    endpoint=os.getenv("YDB_ENDPOINT"),
-    database=os.getenv("YDB_DATABASE"),
-    credentials=ydb.iam.ServiceAccountCredentials.from_file(os.getenv("SA_KEY_FILE"))
-    if os.getenv("LAMBDA_RUNTIME_DIR") is None
-    else ydb.iam.MetadataUrlCredentials(),
-)
-# Wait for the driver to become active for requests.
-driver.wait(fail_fast=True, timeout=5)
-# Create the session pool instance to manage YDB sessions.
-pool = ydb.SessionPool(driver)
+# YDB is connected lazily by get_pool(), see database.py.
+# Rate-limited delivery of replies.
+outbox = Outbox(bot, get_pool)
+startup_timings["import"] = round(time.perf_counter() - import_started, 4)
+cold_start = True
+# Duplicate updates, cooldowns and today's grows, answered without YDB.
+guard = Guard()
+# Commands served by this bot, see pepper-bot-commands.txt.
+COMMANDS = ("pepper", "top_peppers", "pepper_of_the_day", "ball", "stats", "global_top", "timezone")
+# Username of this bot without "@", commands addressed to other bots are skipped.
+BOT_USERNAME = os.getenv("BOT_USERNAME")
+# Telegram accepts one Bot API call in the webhook response. The first reply
+# to an update is returned that way, saving a request to api.telegram.org.
+WEBHOOK_REPLY = os.getenv("WEBHOOK_REPLY", "1") == "1"
+webhook_reply = None
 
 
 # Main handler
 def handler(event, context):
-    print(event)
-    request_body_dict = json.loads(event["body"])
-    update = telebot.types.Update.de_json(request_body_dict)
-    bot.process_new_updates([update])
+    global webhook_reply, cold_start
+    webhook_reply = None
+    request_body_dict = parse_command_update(event["body"])
+    if request_body_dict is None:
+        # not one of our commands, nothing to do
+        return {
+            "statusCode": 200,
+        }
+    command = get_command(request_body_dict)
+    if not guard.admit(request_body_dict, command):
+        # a redelivered update or a command within its cooldown
+        return {
+            "statusCode": 200,
+        }
+    tracing.start("webhook", event)
+    tracing.annotate(update_id=request_body_dict.get("update_id"))
+    try:
+        with tracing.stage("parse"):
+            update = telebot.types.Update.de_json(request_body_dict)
+        with tracing.stage("dispatch"):
+            bot.process_new_updates([update])
+    except Exception:
+        # the webhook fails and Telegram sends the update again
+        guard.forget(request_body_dict, command)
+        raise
+    finally:
+        if cold_start:
+            cold_start = False
+            tracing.annotate(cold_start=startup_timings)
+        tracing.annotate(webhook_reply=webhook_reply is not None)
+        tracing.finish()
+    if webhook_reply:
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(webhook_reply, ensure_ascii=False),
+            "isBase64Encoded": False,
+        }
     return {
         "statusCode": 200,
     }
@@ -45,60 +106,31 @@ def handler(event, context):
 # /pepper
 @bot.message_handler(commands=["pepper"])
 def send_pepper(message):
-    pepper = get_pepper(chat_id=message.chat.id, user_id=message.from_user.id)
-    if pepper:  # checking if we found pepper
-        # if pepper exists
-        now = datetime.now()
-        start_of_day = datetime.timestamp(datetime(now.year, now.month, now.day))
-        if pepper.last_updated < start_of_day:  # checking if updated today
-            # pepper hasn't updated yet
-            grow = grow_pepper(chat_id=message.chat.id, user_id=message.from_user.id)
-            grow_size = grow["bonus"]["size"] if grow["bonus"] else grow["size"]
-            new_size = pepper.size + grow_size
-            updated_pepper = update_pepper_size(
-                chat_id=message.chat.id, user_id=message.from_user.id, size=new_size
-            )
-            if updated_pepper:
-                msg = create_pepper_message(
-                    username=message.from_user.username,
-                    grow_size=grow["size"],
-                    place=updated_pepper.place,
-                    size=updated_pepper.size,
-                    bonus=grow["bonus"],
-                )
-                send_message(message, msg)
-        else:
-            # pepper already updated
-            msg = create_pepper_message(
-                username=message.from_user.username,
-                is_repeat=True,
-                place=pepper.place,
-                size=pepper.size,
-            )
-            send_message(message, msg)
-    else:
-        # if no pepper found, creating new one
-        grow = grow_pepper(chat_id=message.chat.id, user_id=message.from_user.id)
-        grow_size = 0
-        if grow["bonus"] == None:
-            grow_size = grow["size"]
-        else:
-            grow_size = grow["bonus"]["size"]
-        new_pepper = create_pepper(
+    result = guard.grown_today(message.chat.id, message.from_user.id)
+    if result is None:
+        result = grow_pepper_transaction(
             chat_id=message.chat.id,
             user_id=message.from_user.id,
             username=message.from_user.username,
-            size=grow_size,
         )
-        if new_pepper:
-            msg = create_pepper_message(
-                username=message.from_user.username,
-                grow_size=grow["size"],
-                place=new_pepper.place,
-                size=new_pepper.size,
-                bonus=grow["bonus"],
-            )
-            send_message(message, msg)
+        remember_grown(message.chat.id, message.from_user.id, result)
+    if result["is_repeat"]:
+        # pepper already updated
+        msg = create_pepper_message(
+            username=message.from_user.username,
+            is_repeat=True,
+            place=result["place"],
+            size=result["size"],
+        )
+    else:
+        msg = create_pepper_message(
+            username=message.from_user.username,
+            grow_size=result["grow"]["size"],
+            place=result["place"],
+            size=result["size"],
+            bonus=result["grow"]["bonus"],
+        )
+    send_message(message, msg)
 
 
 # /top_peppers
@@ -106,34 +138,30 @@ def send_pepper(message):
 def send_top_peppers(message):
     top_peppers = get_top_peppers(chat_id=message.chat.id)
     if top_peppers:
-        text = "Топ 10 перчиков:\n"
-        for index, pepper in enumerate(top_peppers, start=1):
-            text += "\n{0}| <b>{1}</b> — <b>{2} см</b>".format(
-                index, pepper.username, pepper.size
-            )
-        send_message(message, text)
+        send_message(message, render_top("top_peppers", top_peppers))
     else:
-        send_message(message, "Перчики не найдены в этом чате. Введите /pepper")
+        send_message(message, render("no_peppers"))
 
 
 # /pepper_of_the_day
 @bot.message_handler(commands=["pepper_of_the_day"])
 def send_pepper_of_the_day(message):
-    pepper_of_the_day = get_pepper_of_the_day(message.chat.id)
+    pepper_of_the_day, timezone = get_pepper_of_the_day(message.chat.id)
+    day = today(timezone)
 
     if pepper_of_the_day:
         # if found pepper_of_the_day in table
-        now = datetime.now()
-        start_of_day = datetime.timestamp(datetime(now.year, now.month, now.day))
-        if pepper_of_the_day.last_updated < start_of_day:
+        if day_of(pepper_of_the_day, timezone) < day:
             # if pepper_of_the_day hasn't updated yet
-            random_pepper = get_random_pepper(message.chat.id)
-            update_pepper_of_the_day(message.chat.id, random_pepper.user_id)
+            random_pepper = get_random_pepper(message.chat.id, day)
+            if not random_pepper:
+                # the chat isn't in chat_participants yet
+                send_message(message, render("no_peppers"))
+                return
+            update_pepper_of_the_day(message.chat.id, random_pepper.user_id, day)
             send_message(
                 message,
-                "<b>@{0}</b>, поздравляю! У тебя сегодня самый лучший перчик!".format(
-                    random_pepper.username
-                ),
+                render("pepper_of_the_day", username=random_pepper.username),
                 disable_notification=False,
             )
         else:
@@ -145,55 +173,33 @@ def send_pepper_of_the_day(message):
                 # if got current_pepper_of_the_day
                 send_message(
                     message,
-                    "По результатам сегодняшнего розыгрыша лучший перчик у <b>{0}</b>!".format(
-                        current_pepper_of_the_day.username
+                    render(
+                        "current_pepper_of_the_day",
+                        username=current_pepper_of_the_day.username,
                     ),
                 )
             else:
                 # if no current_pepper_of_the_day found
-                send_message(message, "Перчики не найдены в этом чате. Введите /pepper")
+                send_message(message, render("no_peppers"))
     else:
         # if no pepper_of_the_day found in table
-        random_pepper = get_random_pepper(message.chat.id)
+        random_pepper = get_random_pepper(message.chat.id, day)
         if random_pepper:
             # if got random pepper
-            create_pepper_of_the_day(message.chat.id, random_pepper.user_id)
+            create_pepper_of_the_day(message.chat.id, random_pepper.user_id, day)
             send_message(
                 message,
-                "<b>@{0}</b>, поздравляю! У тебя сегодня самый лучший перчик!".format(
-                    random_pepper.username
-                ),
+                render("pepper_of_the_day", username=random_pepper.username),
             )
         else:
             # if no pepper found
-            send_message(message, "Перчики не найдены в этом чате. Введите /pepper")
+            send_message(message, render("no_peppers"))
 
 
 # /ball
 @bot.message_handler(commands=["ball"])
 def send_ball_response(message):
-    ball_responses = [
-        "Бесспорно",
-        "Предрешено",
-        "Никаких сомнений",
-        "Определённо да",
-        "Можешь быть уверен в этом",
-        "Мне кажется — «да»",
-        "Вероятнее всего",
-        "Хорошие перспективы",
-        "Знаки говорят — «да»",
-        "Пока не ясно, попробуй снова",
-        "Спроси позже",
-        "Лучше не рассказывать",
-        "Сейчас нельзя предсказать",
-        "Сконцентрируйся и спроси опять",
-        "Даже не думай",
-        "Мой ответ — «нет»",
-        "По моим данным — «нет»",
-        "Перспективы не очень хорошие",
-        "Весьма сомнительно",
-    ]
-    ball_response = ball_responses[randrange(0, len(ball_responses))]
+    ball_response = ball_stream(message.chat.id, message.message_id).choice(BALL_RESPONSES)
     send_message(
         message,
         ball_response,
@@ -201,292 +207,172 @@ def send_ball_response(message):
     )
 
 
-# Yandex Database Operations
-def get_pepper(chat_id, user_id):
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM (SELECT ROW_NUMBER() OVER w AS place, peppers.*
-                FROM `peppers`
-                WHERE chat_id = {0}
-                WINDOW w AS (ORDER BY size DESC))
-            WHERE user_id = {1};
-            """.format(
-                chat_id, user_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def create_pepper(chat_id, user_id, username, size):
-    pepper_id = uuid.uuid4()
-    last_updated = int(datetime.timestamp(datetime.now()))
-
-    def callee(session):
-        session.transaction().execute(
-            """
-            UPSERT INTO `peppers` (pepper_id, chat_id, user_id, username, size, last_updated) 
-            VALUES ("{0}", {1}, {2}, "{3}", {4}, {5});
-            """.format(
-                pepper_id, chat_id, user_id, username, size, last_updated
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM (SELECT ROW_NUMBER() OVER w AS place, peppers.*
-                FROM `peppers`
-                WHERE chat_id = {0}
-                WINDOW w AS (ORDER BY size DESC))
-            WHERE user_id = {1};
-            """.format(
-                chat_id, user_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def update_pepper_size(chat_id, user_id, size):
-    last_updated = int(datetime.timestamp(datetime.now()))
-
-    def callee(session):
-        session.transaction().execute(
-            """
-            UPDATE `peppers`
-            SET size = {0}, last_updated = {1}
-            WHERE chat_id = {2} AND user_id = {3};
-            """.format(
-                size, last_updated, chat_id, user_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM (SELECT ROW_NUMBER() OVER w AS place, peppers.*
-                FROM `peppers`
-                WHERE chat_id = {0}
-                WINDOW w AS (ORDER BY size DESC))
-            WHERE chat_id = {1} AND user_id = {2};
-            """.format(
-                chat_id, chat_id, user_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def get_random_pepper(chat_id):
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT * 
-            FROM `peppers` 
-            WHERE chat_id = {} 
-            ORDER BY RANDOM(pepper_id) 
-            LIMIT 1
-            """.format(
-                chat_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def get_top_peppers(chat_id):
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM `peppers`
-            WHERE chat_id = {}
-            ORDER BY size DESC
-            LIMIT 10
-            """.format(
-                chat_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def get_pepper_of_the_day(chat_id):
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM peppers_of_the_day
-            WHERE chat_id = {0};
-            """.format(
-                chat_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
-
-
-def create_pepper_of_the_day(chat_id, user_id):
-    last_updated = int(datetime.timestamp(datetime.now()))
-
-    def callee(session):
-        session.transaction().execute(
-            """
-            UPSERT INTO `peppers_of_the_day` (chat_id, user_id, last_updated) 
-            VALUES ({0}, {1}, {2});
-            """.format(
-                chat_id, user_id, last_updated
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
+# /global_top
+@bot.message_handler(commands=["global_top"])
+def send_global_top(message):
+    send_message(message, create_global_top_message(get_global_top()))
+
+
+# /timezone [name]
+@bot.message_handler(commands=["timezone"])
+def send_timezone(message):
+    timezone = parse_timezone(message)
+    if timezone is None:
+        # the cached pepper of the day comes with the timezone
+        _, current = get_pepper_of_the_day(message.chat.id)
+        send_message(message, render("timezone", timezone=timezone_name(current)))
+    elif not valid_timezone(timezone):
+        send_message(message, render("timezone_unknown", timezone=timezone))
+    elif not can_change_settings(message):
+        send_message(message, render("timezone_admins_only"))
+    else:
+        set_chat_timezone(message.chat.id, timezone)
+        send_message(message, render("timezone_set", timezone=timezone))
 
-    return pool.retry_operation_sync(callee)
-
-
-def update_pepper_of_the_day(chat_id, user_id):
-    last_updated = int(datetime.timestamp(datetime.now()))
-
-    def callee(session):
-        session.transaction().execute(
-            """
-            UPDATE `peppers_of_the_day`
-            SET user_id = {0}, last_updated = {1}
-            WHERE chat_id = {2};
-            """.format(
-                user_id, last_updated, chat_id
-            ),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings()
-            .with_timeout(3)
-            .with_operation_timeout(2),
-        )
 
-    return pool.retry_operation_sync(callee)
+# /stats
+@bot.message_handler(commands=["stats"])
+def send_stats(message):
+    stats, chat = get_stats(message.chat.id, message.from_user.id)
+    send_message(message, create_stats_message(message.from_user.username, stats, chat))
 
 
 # Utils
-def grow_pepper(chat_id, user_id):
-    grow = {"size": 0, "bonus": None}
+def remember_grown(chat_id, user_id, result):
+    # later /pepper calls today get the repeat answer from the guard
+    guard.remember_grown(
+        chat_id, user_id, dict(result, is_repeat=True), ttl=seconds_until_midnight(result["timezone"])
+    )
+
 
-    # get pepper grow size
-    grow_size = randrange(5, 10)
-    grow["size"] = grow_size
+def parse_timezone(message):
+    # the argument of /timezone, None without one
+    parts = (message.text or "").split(maxsplit=1)
+    return parts[1].strip() if len(parts) > 1 else None
 
-    # handling bonuses
-    random_number = randrange(0, 10)
-    if random_number >= 0 and random_number <= 2:
-        grow["bonus"] = {"type": "double_increase", "size": round(grow_size * 2)}
-    top_peppers = get_top_peppers(chat_id)
-    if top_peppers and top_peppers[0].user_id == user_id:
-        grow["bonus"] = {"type": "curse_of_the_first", "size": math.ceil(grow_size / 2)}
 
-    return grow
+def can_change_settings(message):
+    # chat settings are for the admins of groups
+    if message.chat.type == "private":
+        return True
+    member = bot.get_chat_member(message.chat.id, message.from_user.id)
+    return member.status in ("creator", "administrator")
 
 
 def send_message(message, text, disable_notification=True, parse_mode="HTML"):
-    bot.send_message(
-        chat_id=message.chat.id,
-        text=text,
-        parse_mode=parse_mode,
+    global webhook_reply
+    if WEBHOOK_REPLY and webhook_reply is None and outbox.reserve_now(message.chat.id):
+        webhook_reply = {
+            "method": "sendMessage",
+            "chat_id": message.chat.id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "disable_notification": disable_notification,
+        }
+        return
+    # further replies to the same update go through the API
+    outbox.send(
+        message.chat.id,
+        text,
         disable_notification=disable_notification,
+        parse_mode=parse_mode,
     )
 
 
 def create_pepper_message(
     username, size, place, grow_size=0, is_repeat=False, bonus=None
 ):
-    first_line = """@{}, твой перчик """.format(username)
     if is_repeat:
-        first_line = """@{}, ты уже измерял перчик сегодня.\n""".format(username)
+        variant = "pepper_repeat"
+    elif grow_size > 0:
+        variant = "pepper_" + bonus["type"] if bonus else "pepper_grew"
+    elif grow_size == 0:
+        variant = "pepper_unchanged"
     else:
-        if grow_size > 0:
-            first_line += "вырос на <b>{} см</b>.\n".format(grow_size)
-            if bonus:
-                if bonus["type"] == "double_increase":
-                    first_line += "🍀 А еще ты получаешь бонус с двойным ростом и твой перчик сегодня вырастает на <b>{} см</b>!\n".format(
-                        bonus["size"]
-                    )
-                if bonus["type"] == "curse_of_the_first":
-                    first_line += '👑 Но из-за "Проклятия первого" рост твоего перчика сегодня уменьшается вдвое до <b>{} см</b>.\n'.format(
-                        bonus["size"]
-                    )
-        elif grow_size == 0:
-            first_line += "не изменился.\n"
-        else:
-            first_line += "уменьшился на <b>{} см</b>.\n".format(abs(grow_size))
-    second_line = """{0} он равен <b>{1} см</b>.\n""".format(
-        "Сейчас" if is_repeat else "Теперь", size
+        variant = "pepper_shrunk"
+    # the hottest reply, called directly instead of through render()
+    return TEMPLATES[variant](
+        username=username,
+        size=size,
+        place=place,
+        grow=abs(grow_size),
+        bonus=bonus and bonus["size"],
     )
-    third_line = """Ты занимаешь <b>{} место</b> в топе.\n""".format(place)
-    fourth_line = """Следующая попытка завтра!"""
-    return first_line + second_line + third_line + fourth_line
+
+
+def create_global_top_message(global_top):
+    if not global_top:
+        return render("no_global_peppers")
+    return render_top("global_top", global_top[:10])
+
+
+def create_stats_message(username, stats, chat):
+    if stats:
+        # the streak is broken if yesterday was missed
+        streak = stats.streak if stats.last_day >= today(chat and chat.timezone) - 1 else 0
+        parts = [
+            (
+                "stats",
+                {
+                    "username": username,
+                    "grows": stats.grows,
+                    "total_growth": stats.total_growth,
+                    "streak": streak,
+                    "best_streak": stats.best_streak,
+                },
+            )
+        ]
+        counts = bonus_counts(stats)
+        parts += [
+            ("bonus_stats_" + bonus.type, {"count": counts.get(bonus.type, 0)})
+            for bonus in RULES.bonuses
+        ]
+    else:
+        parts = [("no_stats", {"username": username})]
+    if chat and chat.participants:
+        parts.append(
+            ("chat_average", {"size": round((chat.total_growth or 0) / chat.participants, 1)})
+        )
+        if chat.grows:
+            parts.append(
+                ("chat_average_grow", {"grow": round(chat.total_growth / chat.grows, 1)})
+            )
+    return render_many(parts)
+
+
+def parse_command_update(body):
+    # Returns the decoded update if it is a message with one of COMMANDS,
+    # None otherwise. Most updates are plain chat messages, they are
+    # rejected by a substring check without decoding the body.
+    if '"bot_command"' not in body:
+        return None
+    update = json.loads(body)
+    if get_command(update) is None:
+        return None
+    return update
+
+
+def get_command(update):
+    # Name of the command in a decoded update, None if it isn't one of COMMANDS.
+    message = update.get("message")
+    if not message:
+        return None
+    text = message.get("text") or ""
+    if not text.startswith("/"):
+        return None
+    command, _, username = text.split(maxsplit=1)[0][1:].partition("@")
+    if username and BOT_USERNAME and username.lower() != BOT_USERNAME.lower():
+        return None
+    if command not in COMMANDS:
+        return None
+    return command
 
 
 def extract_unique_code(text):
     return " ".join(text.split()[1:]) if len(text.split()) > 1 else None
 
 
-if os.getenv("LAMBDA_RUNTIME_DIR") is None:
+if __name__ == "__main__" and os.getenv("LAMBDA_RUNTIME_DIR") is None:
     from faker import event, context
 
     handler(event, context)
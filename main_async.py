@@ -0,0 +1,475 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+from dotenv import load_dotenv
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot, ExceptionHandler
+import queries
+import tracing
+from database import get_async_pool
+from outbox import AsyncOutbox
+from main import (
+    WEBHOOK_REPLY,
+    create_global_top_message,
+    create_pepper_message,
+    create_stats_message,
+    get_command,
+    guard,
+    parse_command_update,
+    parse_timezone,
+    remember_grown,
+)
+from repository import (
+    chat_timezone_steps,
+    day_of,
+    get_pepper_steps,
+    global_top_cache,
+    global_top_steps,
+    global_top_threshold_steps,
+    grow_pepper_steps,
+    grow_peppers_batch_steps,
+    pepper_of_the_day_cache,
+    pepper_of_the_day_steps,
+    random_pepper_steps,
+    stats_steps,
+    timezone_name,
+    today,
+    top_peppers_cache,
+    top_peppers_steps,
+    valid_timezone,
+    write_pepper_of_the_day_steps,
+)
+from rng import ball_stream
+from templates import BALL_RESPONSES, render, render_top
+
+# asyncio version of main.py on AsyncTeleBot and ydb.aio, with the same
+# commands and the async counterparts of repository.py. Independent
+# queries and sends run concurrently, and in container mode
+# (`python main_async.py`) one process serves many updates at once.
+
+# init
+load_dotenv()
+logger = logging.getLogger("main_async")
+if os.getenv("TELEGRAM_API_URL"):
+    asyncio_helper.API_URL = os.getenv("TELEGRAM_API_URL")
+class KeepHandlerError(ExceptionHandler):
+    # AsyncTeleBot only logs the errors of handlers. Keep them for
+    # handle_update, which fails the request like main.handler so Telegram
+    # sends the update again, and for server.py, which retries the update.
+    async def handle(self, exception):
+        state = handler_error.get()
+        if state is None:
+            return False
+        state["error"] = exception
+        return True
+
+
+bot = AsyncTeleBot(os.getenv("TELEGRAM_TOKEN"), parse_mode="HTML", exception_handler=KeepHandlerError())
+outbox = AsyncOutbox(bot, get_async_pool)
+# Holds {"reply": ..., "error": ...} for the update being handled. The handlers run in
+# tasks of their own, so they fill in the dict instead of setting the var.
+webhook_reply = contextvars.ContextVar("webhook_reply", default=None)
+# Holds {"error": ...} that KeepHandlerError fills in, the same dict as
+# webhook_reply in handle_update.
+handler_error = contextvars.ContextVar("handler_error", default=None)
+
+
+# Cloud Function handler
+async def handler(event, context):
+    return await handle_update(event, event["body"])
+
+
+async def handle_update(event, body):
+    request_body_dict = parse_command_update(body)
+    if request_body_dict is None:
+        # not one of our commands, nothing to do
+        return {
+            "statusCode": 200,
+        }
+    command = get_command(request_body_dict)
+    if not guard.admit(request_body_dict, command):
+        return {
+            "statusCode": 200,
+        }
+    reply = {"reply": None, "error": None}
+    webhook_reply.set(reply)
+    handler_error.set(reply)
+    tracing.start("webhook_async", event)
+    tracing.annotate(update_id=request_body_dict.get("update_id"))
+    try:
+        from telebot import types
+
+        with tracing.stage("parse"):
+            update = types.Update.de_json(request_body_dict)
+        with tracing.stage("dispatch"):
+            await bot.process_new_updates([update])
+        if reply["error"] is not None:
+            raise reply["error"]
+    except Exception:
+        guard.forget(request_body_dict, command)
+        raise
+    finally:
+        tracing.annotate(webhook_reply=reply["reply"] is not None)
+        tracing.finish()
+    if reply["reply"]:
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(reply["reply"], ensure_ascii=False),
+            "isBase64Encoded": False,
+        }
+    return {
+        "statusCode": 200,
+    }
+
+
+# Telegram commands
+# /pepper
+@bot.message_handler(commands=["pepper"])
+async def send_pepper(message):
+    result = guard.grown_today(message.chat.id, message.from_user.id)
+    if result is None:
+        result = await grow_pepper_transaction(
+            chat_id=message.chat.id,
+            user_id=message.from_user.id,
+            username=message.from_user.username,
+        )
+        remember_grown(message.chat.id, message.from_user.id, result)
+    if result["is_repeat"]:
+        msg = create_pepper_message(
+            username=message.from_user.username,
+            is_repeat=True,
+            place=result["place"],
+            size=result["size"],
+        )
+    else:
+        msg = create_pepper_message(
+            username=message.from_user.username,
+            grow_size=result["grow"]["size"],
+            place=result["place"],
+            size=result["size"],
+            bonus=result["grow"]["bonus"],
+        )
+    await send_message(message, msg)
+
+
+# /pepper for several messages of one chat at once, used by server.py
+async def send_peppers(messages):
+    chat_id = messages[0].chat.id
+    results = {}
+    users = {}
+    for message in messages:
+        result = guard.grown_today(chat_id, message.from_user.id)
+        if result is not None:
+            results[message.from_user.id] = result
+        else:
+            users.setdefault(message.from_user.id, message.from_user.username)
+    if users:
+        grown = await grow_peppers_batch(chat_id, users)
+        for user_id, result in grown.items():
+            remember_grown(chat_id, user_id, result)
+        results.update(grown)
+
+    replied = set()
+    sends = []
+    for message in messages:
+        result = results[message.from_user.id]
+        if result["is_repeat"] or message.from_user.id in replied:
+            msg = create_pepper_message(
+                username=message.from_user.username,
+                is_repeat=True,
+                place=result["place"],
+                size=result["size"],
+            )
+        else:
+            msg = create_pepper_message(
+                username=message.from_user.username,
+                grow_size=result["grow"]["size"],
+                place=result["place"],
+                size=result["size"],
+                bonus=result["grow"]["bonus"],
+            )
+        replied.add(message.from_user.id)
+        sends.append(send_message(message, msg))
+    await asyncio.gather(*sends)
+
+
+# /top_peppers
+@bot.message_handler(commands=["top_peppers"])
+async def send_top_peppers(message):
+    top_peppers = await get_top_peppers(chat_id=message.chat.id)
+    if top_peppers:
+        await send_message(message, render_top("top_peppers", top_peppers))
+    else:
+        await send_message(message, render("no_peppers"))
+
+
+# /pepper_of_the_day
+@bot.message_handler(commands=["pepper_of_the_day"])
+async def send_pepper_of_the_day(message):
+    pepper_of_the_day, timezone = await get_pepper_of_the_day(message.chat.id)
+    day = today(timezone)
+
+    if pepper_of_the_day:
+        if day_of(pepper_of_the_day, timezone) < day:
+            # if pepper_of_the_day hasn't updated yet
+            random_pepper = await get_random_pepper(message.chat.id, day)
+            if not random_pepper:
+                # the chat isn't in chat_participants yet
+                await send_message(message, render("no_peppers"))
+                return
+            # the write and the announcement don't depend on each other
+            await asyncio.gather(
+                update_pepper_of_the_day(message.chat.id, random_pepper.user_id, day),
+                send_message(
+                    message,
+                    render("pepper_of_the_day", username=random_pepper.username),
+                    disable_notification=False,
+                ),
+            )
+        else:
+            # if pepper already updated today
+            current_pepper_of_the_day = await get_pepper(
+                message.chat.id, pepper_of_the_day.user_id
+            )
+            if current_pepper_of_the_day:
+                await send_message(
+                    message,
+                    render(
+                        "current_pepper_of_the_day",
+                        username=current_pepper_of_the_day.username,
+                    ),
+                )
+            else:
+                await send_message(message, render("no_peppers"))
+    else:
+        # if no pepper_of_the_day found in table
+        random_pepper = await get_random_pepper(message.chat.id, day)
+        if random_pepper:
+            await asyncio.gather(
+                create_pepper_of_the_day(message.chat.id, random_pepper.user_id, day),
+                send_message(
+                    message,
+                    render("pepper_of_the_day", username=random_pepper.username),
+                ),
+            )
+        else:
+            await send_message(message, render("no_peppers"))
+
+
+# /ball
+@bot.message_handler(commands=["ball"])
+async def send_ball_response(message):
+    ball_response = ball_stream(message.chat.id, message.message_id).choice(BALL_RESPONSES)
+    await send_message(
+        message,
+        ball_response,
+        disable_notification=False,
+    )
+
+
+# /global_top
+@bot.message_handler(commands=["global_top"])
+async def send_global_top(message):
+    await send_message(message, create_global_top_message(await get_global_top()))
+
+
+# /timezone [name]
+@bot.message_handler(commands=["timezone"])
+async def send_timezone(message):
+    timezone = parse_timezone(message)
+    if timezone is None:
+        _, current = await get_pepper_of_the_day(message.chat.id)
+        await send_message(message, render("timezone", timezone=timezone_name(current)))
+    elif not valid_timezone(timezone):
+        await send_message(message, render("timezone_unknown", timezone=timezone))
+    elif not await can_change_settings(message):
+        await send_message(message, render("timezone_admins_only"))
+    else:
+        await set_chat_timezone(message.chat.id, timezone)
+        await send_message(message, render("timezone_set", timezone=timezone))
+
+
+# /stats
+@bot.message_handler(commands=["stats"])
+async def send_stats(message):
+    stats, chat = await get_stats(message.chat.id, message.from_user.id)
+    await send_message(message, create_stats_message(message.from_user.username, stats, chat))
+
+
+# Yandex Database Operations
+# The step generators of repository.py on the asyncio pool.
+async def get_pepper(chat_id, user_id):
+    async def callee(session):
+        return await queries.run_async(session, get_pepper_steps(chat_id, user_id))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def grow_pepper_transaction(chat_id, user_id, username):
+    threshold = await global_top_threshold()
+
+    async def callee(session):
+        return await queries.run_async(session, grow_pepper_steps(chat_id, user_id, username, threshold))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def grow_peppers_batch(chat_id, users):
+    # see repository.grow_peppers_batch_steps
+    threshold = await global_top_threshold()
+
+    async def callee(session):
+        return await queries.run_async(session, grow_peppers_batch_steps(chat_id, users, threshold))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def get_random_pepper(chat_id, day, weighted=False):
+    async def callee(session):
+        return await queries.run_async(session, random_pepper_steps(chat_id, day, weighted))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def get_stats(chat_id, user_id):
+    async def callee(session):
+        return await queries.run_async(session, stats_steps(chat_id, user_id))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def get_top_peppers(chat_id):
+    top_peppers = top_peppers_cache.get(chat_id)
+    if top_peppers is not None:
+        return top_peppers
+
+    async def callee(session):
+        return await queries.run_async(session, top_peppers_steps(chat_id))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def get_global_top():
+    global_top = global_top_cache.get("global")
+    if global_top is not None:
+        return global_top
+
+    async def callee(session):
+        import ydb
+
+        return await queries.run_async(session, global_top_steps(), ydb.OnlineReadOnly())
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def global_top_threshold():
+    threshold = global_top_cache.get("threshold")
+    if threshold is not None:
+        return threshold
+
+    async def callee(session):
+        import ydb
+
+        return await queries.run_async(session, global_top_threshold_steps(), ydb.OnlineReadOnly())
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def get_pepper_of_the_day(chat_id):
+    cached = pepper_of_the_day_cache.get(chat_id)
+    if cached is not None:
+        return cached
+
+    async def callee(session):
+        return await queries.run_async(session, pepper_of_the_day_steps(chat_id))
+
+    return await (await get_async_pool()).retry_operation(callee)
+
+
+async def create_pepper_of_the_day(chat_id, user_id, day):
+    async def callee(session):
+        return await queries.run_async(
+            session, write_pepper_of_the_day_steps(queries.CREATE_PEPPER_OF_THE_DAY, chat_id, user_id, day)
+        )
+
+    await (await get_async_pool()).retry_operation(callee)
+
+
+async def update_pepper_of_the_day(chat_id, user_id, day):
+    async def callee(session):
+        return await queries.run_async(
+            session, write_pepper_of_the_day_steps(queries.UPDATE_PEPPER_OF_THE_DAY, chat_id, user_id, day)
+        )
+
+    await (await get_async_pool()).retry_operation(callee)
+
+
+async def set_chat_timezone(chat_id, timezone):
+    async def callee(session):
+        return await queries.run_async(session, chat_timezone_steps(chat_id, timezone))
+
+    await (await get_async_pool()).retry_operation(callee)
+
+
+# Utils
+async def can_change_settings(message):
+    # see main.can_change_settings
+    if message.chat.type == "private":
+        return True
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    return member.status in ("creator", "administrator")
+
+
+async def send_message(message, text, disable_notification=True, parse_mode="HTML"):
+    reply = webhook_reply.get()
+    if (
+        WEBHOOK_REPLY
+        and reply is not None
+        and reply["reply"] is None
+        and outbox.reserve_now(message.chat.id)
+    ):
+        reply["reply"] = {
+            "method": "sendMessage",
+            "chat_id": message.chat.id,
+            "text": text,
+            "parse_mode": parse_mode,
+            "disable_notification": disable_notification,
+        }
+        return
+    await outbox.send(
+        message.chat.id,
+        text,
+        disable_notification=disable_notification,
+        parse_mode=parse_mode,
+    )
+
+
+# Container mode: a long-running aiohttp server taking Telegram webhooks.
+# Every request is handled in its own task, so slow queries of one update
+# don't hold up the others.
+def create_app():
+    from aiohttp import web
+
+    async def webhook(request):
+        body = await request.text()
+        event = {"headers": dict(request.headers), "body": body}
+        response = await handle_update(event, body)
+        return web.Response(
+            status=response["statusCode"],
+            text=response.get("body", ""),
+            content_type="application/json" if "body" in response else "text/plain",
+        )
+
+    app = web.Application()
+    app.router.add_post(os.getenv("WEBHOOK_PATH", "/"), webhook)
+    return app
+
+
+if __name__ == "__main__":
+    from aiohttp import web
+
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(create_app(), port=int(os.getenv("PORT", "8080")))
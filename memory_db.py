@@ -0,0 +1,340 @@
+import threading
+import time
+from types import SimpleNamespace
+import queries
+
+# In-memory stand-in for the YDB session pool, used by benchmark.py.
+# It answers the statements from queries.py with Python code instead of
+# YQL, so the bot code runs unchanged against it. Every statement batch
+# and commit counts as one round-trip and can be delayed by `latency`
+# seconds to model the network.
+
+
+class ResultSet:
+    def __init__(self, rows):
+        self.rows = [SimpleNamespace(**row) for row in rows]
+
+
+class MemoryDatabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.peppers = {}
+        self.peppers_of_the_day = {}
+        self.chats = {}
+        self.chat_participants = {}
+        self.pepper_events = []
+        self.pepper_stats = {}
+        self.global_top = {}
+        self.outbox = {}
+        self.round_trips = 0
+        self.handlers = {
+            queries.GET_PEPPER: self.get_pepper,
+            queries.GROW_READ: self.grow_read,
+            queries.GROW_WRITE: self.grow_write,
+            queries.GROW_BATCH_READ: self.grow_batch_read,
+            queries.GROW_BATCH_READ_PLACES: self.grow_batch_read_places,
+            queries.GROW_BATCH_WRITE: self.grow_batch_write,
+            queries.ADD_PARTICIPANTS: self.add_participants,
+            queries.GET_STATS: self.get_stats,
+            queries.GET_GLOBAL_TOP: self.get_global_top,
+            queries.GET_GLOBAL_TOP_THRESHOLD: self.get_global_top_threshold,
+            queries.COMPACT_GLOBAL_TOP: self.compact_global_top,
+            queries.GET_RANDOM_PEPPER: self.get_random_pepper,
+            queries.GET_WEIGHTED_RANDOM_PEPPER: self.get_weighted_random_pepper,
+            queries.GET_TOP_PEPPERS: self.get_top_peppers,
+            queries.GET_PEPPER_OF_THE_DAY: self.get_pepper_of_the_day,
+            queries.GET_PEPPERS_OF_THE_DAY: self.get_peppers_of_the_day,
+            queries.DRAW_PEPPERS_OF_THE_DAY: self.draw_peppers_of_the_day,
+            queries.SAVE_PEPPERS_OF_THE_DAY: self.save_peppers_of_the_day,
+            queries.CREATE_PEPPER_OF_THE_DAY: self.upsert_pepper_of_the_day,
+            queries.UPDATE_PEPPER_OF_THE_DAY: self.upsert_pepper_of_the_day,
+            queries.SET_CHAT_TIMEZONE: self.set_chat_timezone,
+            queries.ENQUEUE_OUTBOX_MESSAGE: self.enqueue_outbox_message,
+            queries.GET_DUE_OUTBOX_MESSAGES: self.get_due_outbox_messages,
+            queries.DELETE_OUTBOX_MESSAGE: self.delete_outbox_message,
+            queries.RESCHEDULE_OUTBOX_MESSAGE: self.reschedule_outbox_message,
+        }
+
+    def load(self, table, rows):
+        # rows of a snapshot.py chunk
+        for row in rows:
+            if table == "peppers":
+                self.peppers[(row["chat_id"], row["user_id"])] = dict(dict(day=None), **row)
+            elif table == "peppers_of_the_day":
+                self.peppers_of_the_day[row["chat_id"]] = dict(dict(day=None), **row)
+            elif table == "chats":
+                self.chats[row["chat_id"]] = row
+            elif table == "pepper_stats":
+                self.pepper_stats[(row["chat_id"], row["user_id"])] = row
+            elif table == "pepper_events":
+                self.pepper_events.append(row)
+            elif table == "global_top":
+                self.global_top[(row["chat_id"], row["user_id"])] = row
+            elif table == "chat_participants":
+                self.chat_participants[(row["chat_id"], row["seq"])] = row["user_id"]
+
+    # session pool interface
+    def retry_operation_sync(self, callee, *args, **kwargs):
+        return callee(MemorySession(self), *args, **kwargs)
+
+    async def retry_operation(self, callee, *args, **kwargs):
+        return await callee(AsyncMemorySession(self), *args, **kwargs)
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def execute(self, query, parameters):
+        self.round_trip()
+        handler = self.handlers.get(query)
+        if handler is None:
+            raise NotImplementedError("memory_db has no handler for query:\n" + query)
+        params = {key.lstrip("$"): value for key, value in (parameters or {}).items()}
+        with self.lock:
+            return handler(**params)
+
+    # statements
+    def place(self, chat_id, size, user_id=None):
+        return 1 + sum(
+            1
+            for pepper in self.peppers.values()
+            if pepper["chat_id"] == chat_id and pepper["user_id"] != user_id and pepper["size"] > size
+        )
+
+    def chat_peppers(self, chat_id):
+        return [pepper for pepper in self.peppers.values() if pepper["chat_id"] == chat_id]
+
+    def get_pepper(self, chat_id, user_id):
+        pepper = self.peppers.get((chat_id, user_id))
+        if pepper is None:
+            return [ResultSet([])]
+        return [ResultSet([dict(pepper, place=self.place(chat_id, pepper["size"]))])]
+
+    def grow_read(self, chat_id, user_id):
+        top = sorted(self.chat_peppers(chat_id), key=lambda pepper: -pepper["size"])[:1]
+        return (
+            self.get_pepper(chat_id, user_id)
+            + [ResultSet(top)]
+            + self.get_stats(chat_id, user_id)
+            + [self.global_top_members(chat_id, [user_id])]
+        )
+
+    def global_top_members(self, chat_id, user_ids):
+        return ResultSet([dict(user_id=user_id) for user_id in user_ids if (chat_id, user_id) in self.global_top])
+
+    def record_growth(self, chat_id, events, stats, chat_grows, chat_total_growth, global_top):
+        self.pepper_events.extend(events)
+        for row in global_top:
+            self.global_top[(row["chat_id"], row["user_id"])] = row
+        for row in stats:
+            self.pepper_stats[(row["chat_id"], row["user_id"])] = row
+        chat = self.chats.setdefault(chat_id, dict(chat_id=chat_id, participants=None))
+        chat.update(grows=chat_grows, total_growth=chat_total_growth)
+
+    def get_stats(self, chat_id, user_id):
+        stats = self.pepper_stats.get((chat_id, user_id))
+        chat = self.chats.get(chat_id)
+        return [
+            ResultSet([stats] if stats else []),
+            ResultSet([dict(dict(grows=None, total_growth=None, timezone=None), **chat)] if chat else []),
+        ]
+
+    def grow_write(self, pepper_id, chat_id, user_id, username, size, last_updated, day, **growth):
+        self.record_growth(chat_id, **growth)
+        place = self.place(chat_id, size, user_id)
+        self.peppers[(chat_id, user_id)] = dict(
+            pepper_id=pepper_id,
+            chat_id=chat_id,
+            user_id=user_id,
+            username=username,
+            size=size,
+            last_updated=last_updated,
+            day=day,
+        )
+        return [ResultSet([dict(place=place)])]
+
+    def grow_batch_read(self, chat_id, user_ids):
+        peppers = [
+            self.peppers[(chat_id, user_id)] for user_id in user_ids if (chat_id, user_id) in self.peppers
+        ]
+        top = sorted(self.chat_peppers(chat_id), key=lambda pepper: -pepper["size"])[:1]
+        stats = [
+            self.pepper_stats[(chat_id, user_id)] for user_id in user_ids if (chat_id, user_id) in self.pepper_stats
+        ]
+        return [
+            ResultSet(peppers),
+            ResultSet(top),
+            ResultSet(stats),
+            self.get_stats(chat_id, None)[1],
+            self.global_top_members(chat_id, user_ids),
+        ]
+
+    def grow_batch_read_places(self, chat_id, user_ids):
+        places = [
+            dict(user_id=user_id, place=self.place(chat_id, self.peppers[(chat_id, user_id)]["size"]))
+            for user_id in user_ids
+            if (chat_id, user_id) in self.peppers
+        ]
+        return self.grow_batch_read(chat_id, user_ids) + [
+            ResultSet([row for row in places if row["place"] > 1])
+        ]
+
+    def grow_batch_write(self, chat_id, min_size, sizes, peppers, **growth):
+        self.record_growth(chat_id, **growth)
+        batch = {row["user_id"] for row in sizes}
+        others = [
+            pepper["size"]
+            for pepper in self.chat_peppers(chat_id)
+            if pepper["user_id"] not in batch and pepper["size"] > min_size
+        ]
+        above = [
+            dict(user_id=row["user_id"], above=sum(1 for size in others if size > row["size"]))
+            for row in sizes
+        ]
+        above = [row for row in above if row["above"]]
+        for pepper in peppers:
+            self.peppers[(pepper["chat_id"], pepper["user_id"])] = dict(pepper)
+        return [ResultSet(above)]
+
+    def add_participants(self, chat_id, user_ids):
+        chat = self.chats.setdefault(chat_id, dict(chat_id=chat_id, participants=None))
+        participants = chat["participants"] or 0
+        for seq, user_id in enumerate(user_ids, start=participants):
+            self.chat_participants[(chat_id, seq)] = user_id
+        chat["participants"] = participants + len(user_ids)
+        return []
+
+    def draw(self, chat_id, draw):
+        participants = self.chats.get(chat_id, {}).get("participants")
+        if not participants:
+            return None
+        user_id = self.chat_participants[(chat_id, min(int(draw * participants), participants - 1))]
+        return self.peppers[(chat_id, user_id)]
+
+    def get_global_top_threshold(self, global_top_size):
+        top = sorted(self.global_top.values(), key=lambda pepper: -pepper["size"])
+        return [ResultSet(top[global_top_size - 1:global_top_size])]
+
+    def get_global_top(self, limit):
+        return [ResultSet(sorted(self.global_top.values(), key=lambda pepper: -pepper["size"])[:limit])]
+
+    def compact_global_top(self, limit):
+        keep = sorted(self.global_top.items(), key=lambda item: -item[1]["size"])[:limit]
+        self.global_top = dict(keep)
+        return []
+
+    def get_random_pepper(self, chat_id, draws):
+        peppers = [self.draw(chat_id, draw) for draw in draws]
+        return [ResultSet([pepper for pepper in peppers if pepper])]
+
+    def get_weighted_random_pepper(self, chat_id, draws):
+        top = sorted(self.chat_peppers(chat_id), key=lambda pepper: -pepper["size"])[:1]
+        return self.get_random_pepper(chat_id, draws) + [ResultSet(top)]
+
+    def get_top_peppers(self, chat_id):
+        top = sorted(self.chat_peppers(chat_id), key=lambda pepper: -pepper["size"])
+        return [ResultSet(top[:10])]
+
+    def get_pepper_of_the_day(self, chat_id):
+        pepper_of_the_day = self.peppers_of_the_day.get(chat_id)
+        chat = self.chats.get(chat_id)
+        return [
+            ResultSet([pepper_of_the_day] if pepper_of_the_day else []),
+            ResultSet([dict(timezone=chat.get("timezone"))] if chat else []),
+        ]
+
+    def get_peppers_of_the_day(self, timezone, after, limit):
+        page = sorted(
+            chat_id
+            for chat_id, chat in self.chats.items()
+            if chat.get("timezone") == timezone and chat_id > after and chat_id in self.peppers_of_the_day
+        )[:limit]
+        return [ResultSet([self.peppers_of_the_day[chat_id] for chat_id in page])]
+
+    def set_chat_timezone(self, chat_id, timezone):
+        self.chats.setdefault(chat_id, dict(chat_id=chat_id, participants=None))["timezone"] = timezone
+        return []
+
+    def draw_peppers_of_the_day(self, draws):
+        winners = []
+        for draw in draws:
+            winner = self.draw(draw["chat_id"], draw["draw"])
+            if winner:
+                winners.append(dict(chat_id=winner["chat_id"], user_id=winner["user_id"], username=winner["username"]))
+        return [ResultSet(winners)]
+
+    def save_peppers_of_the_day(self, peppers_of_the_day):
+        for pepper_of_the_day in peppers_of_the_day:
+            self.peppers_of_the_day[pepper_of_the_day["chat_id"]] = dict(pepper_of_the_day)
+        return []
+
+    def upsert_pepper_of_the_day(self, chat_id, user_id, last_updated, day):
+        self.peppers_of_the_day[chat_id] = dict(chat_id=chat_id, user_id=user_id, last_updated=last_updated, day=day)
+        return []
+
+    def enqueue_outbox_message(self, **message):
+        self.outbox[(message["created_at"], message["message_id"])] = message
+        return []
+
+    def get_due_outbox_messages(self, now, limit):
+        due = sorted(
+            (message for message in self.outbox.values() if message["next_attempt"] <= now),
+            key=lambda message: message["created_at"],
+        )
+        return [ResultSet(due[:limit])]
+
+    def delete_outbox_message(self, created_at, message_id):
+        self.outbox.pop((created_at, message_id), None)
+        return []
+
+    def reschedule_outbox_message(self, created_at, message_id, next_attempt):
+        self.outbox[(created_at, message_id)]["next_attempt"] = next_attempt
+        return []
+
+
+class MemorySession:
+    def __init__(self, database):
+        self.database = database
+
+    def prepare(self, query, settings=None):
+        return query
+
+    def transaction(self, tx_mode=None):
+        return MemoryTransaction(self.database)
+
+
+class MemoryTransaction:
+    def __init__(self, database):
+        self.database = database
+
+    def execute(self, query, parameters=None, commit_tx=False, settings=None):
+        return self.database.execute(query, parameters)
+
+    def commit(self, settings=None):
+        self.database.round_trip()
+
+    def rollback(self, settings=None):
+        self.database.round_trip()
+
+
+# ydb.aio flavour for main_async.py
+class AsyncMemorySession(MemorySession):
+    async def prepare(self, query, settings=None):
+        return query
+
+    def transaction(self, tx_mode=None):
+        return AsyncMemoryTransaction(self.database)
+
+
+class AsyncMemoryTransaction(MemoryTransaction):
+    async def execute(self, query, parameters=None, commit_tx=False, settings=None):
+        return self.database.execute(query, parameters)
+
+    async def commit(self, settings=None):
+        self.database.round_trip()
+
+    async def rollback(self, settings=None):
+        self.database.round_trip()
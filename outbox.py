@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from telebot.apihelper import ApiTelegramException
+import queries
+import tracing
+
+logger = logging.getLogger("outbox")
+
+# Telegram limits: about 30 messages per second overall and about
+# 20 messages per minute in a group. Private chats allow about one
+# message per second.
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+PRIVATE_RATE = 1
+PRIVATE_BURST = 1
+# How long a sender may block waiting for a token before the message is
+# put into the persistent queue instead.
+MAX_WAIT = 5
+MAX_ATTEMPTS = 5
+DRAIN_BATCH_SIZE = 100
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self):
+        # seconds until the next token is available
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        # may go below zero, later callers then wait for the refill
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        # Telegram asked us to back off, no tokens until it is over
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class Outbox:
+    def __init__(self, bot, get_pool, max_wait=MAX_WAIT):
+        self.bot = bot
+        # called only when the queue is used, so the YDB pool stays lazy
+        self.get_pool = get_pool
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative
+            if chat_id < 0:
+                bucket = TokenBucket(GROUP_RATE, GROUP_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _reserve(self, chat_id, max_wait=None):
+        # Returns how long to sleep before sending, or None when the wait
+        # would exceed max_wait and the message should be queued.
+        if max_wait is None:
+            max_wait = self.max_wait
+        with self.lock:
+            bucket = self._chat_bucket(chat_id)
+            delay = max(self.global_bucket.delay(), bucket.delay())
+            if delay > max_wait:
+                return None
+            self.global_bucket.take()
+            bucket.take()
+            return delay
+
+    def reserve_now(self, chat_id):
+        # Takes a token if one is free right now. Used for replies that are
+        # sent by other means, e.g. in the webhook response.
+        return self._reserve(chat_id, max_wait=0) is not None
+
+    def _backoff(self, chat_id, retry_after):
+        # A 429 doesn't say which limit was hit. If the chat still had a
+        # token it was within its own limit, so the flood limit is bot-wide
+        # and every chat waits.
+        with self.lock:
+            bucket = self._chat_bucket(chat_id)
+            if bucket.delay() == 0:
+                self.global_bucket.pause(retry_after)
+            bucket.pause(retry_after)
+
+    def try_send(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        # Sends within max_wait, returns False if the rate limits did not allow it.
+        record = {"method": "sendMessage", "chat_id": chat_id, "attempts": 0, "waited_ms": 0}
+        started = time.perf_counter()
+        try:
+            for _ in range(MAX_ATTEMPTS):
+                delay = self._reserve(chat_id)
+                if delay is None:
+                    record["result"] = "limited"
+                    return False
+                if delay:
+                    time.sleep(delay)
+                    record["waited_ms"] += tracing.ms(delay)
+                record["attempts"] += 1
+                try:
+                    self.bot.send_message(
+                        chat_id=chat_id,
+                        text=text,
+                        parse_mode=parse_mode,
+                        disable_notification=disable_notification,
+                    )
+                    record["result"] = "sent"
+                    return True
+                except ApiTelegramException as e:
+                    if e.error_code != 429:
+                        record["result"] = "error {}".format(e.error_code)
+                        raise
+                    retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                    logger.warning("429 for chat %s, retry after %s s", chat_id, retry_after)
+                    self._backoff(chat_id, retry_after)
+            record["result"] = "limited"
+            return False
+        finally:
+            record["ms"] = tracing.ms(time.perf_counter() - started)
+            tracing.record_send(record)
+
+    def send(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        # Sends now or queues the message for drain(), it is never dropped.
+        if not self.try_send(chat_id, text, disable_notification, parse_mode):
+            self.enqueue(chat_id, text, disable_notification, parse_mode)
+            tracing.annotate(queued=True)
+
+    def enqueue(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        now = int(time.time())
+
+        def callee(session):
+            queries.execute(
+                session,
+                session.transaction(),
+                queries.ENQUEUE_OUTBOX_MESSAGE,
+                {
+                    "$created_at": now,
+                    "$message_id": str(uuid.uuid4()),
+                    "$chat_id": chat_id,
+                    "$text": text,
+                    "$parse_mode": parse_mode,
+                    "$disable_notification": disable_notification,
+                    "$next_attempt": now,
+                },
+                commit_tx=True,
+            )
+
+        return self.get_pool().retry_operation_sync(callee)
+
+    def drain(self):
+        # Sends queued messages that are due. Messages still limited are
+        # rescheduled, so a later run picks them up.
+        now = int(time.time())
+
+        def get_due(session):
+            result_sets = queries.execute(
+                session,
+                session.transaction(),
+                queries.GET_DUE_OUTBOX_MESSAGES,
+                {"$now": now, "$limit": DRAIN_BATCH_SIZE},
+                commit_tx=True,
+            )
+            return result_sets[0].rows
+
+        sent = 0
+        for message in self.get_pool().retry_operation_sync(get_due):
+            try:
+                delivered = self.try_send(
+                    message.chat_id,
+                    message.text,
+                    message.disable_notification,
+                    message.parse_mode,
+                )
+            except ApiTelegramException:
+                logger.exception("Dropping undeliverable message %s", message.message_id)
+                delivered = True
+            if delivered:
+                sent += 1
+                self._delete(message)
+            else:
+                self._reschedule(message, now + self.max_wait)
+        return sent
+
+    def _delete(self, message):
+        def callee(session):
+            queries.execute(
+                session,
+                session.transaction(),
+                queries.DELETE_OUTBOX_MESSAGE,
+                {"$created_at": message.created_at, "$message_id": message.message_id},
+                commit_tx=True,
+            )
+
+        return self.get_pool().retry_operation_sync(callee)
+
+    def _reschedule(self, message, next_attempt):
+        def callee(session):
+            queries.execute(
+                session,
+                session.transaction(),
+                queries.RESCHEDULE_OUTBOX_MESSAGE,
+                {
+                    "$created_at": message.created_at,
+                    "$message_id": message.message_id,
+                    "$next_attempt": next_attempt,
+                },
+                commit_tx=True,
+            )
+
+        return self.get_pool().retry_operation_sync(callee)
+
+
+class AsyncOutbox(Outbox):
+    # Outbox for AsyncTeleBot: the same buckets, but waits with asyncio.sleep
+    # and queues through the ydb.aio pool returned by `get_pool` (a coroutine).
+    async def try_send(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        # imported here, it pulls in aiohttp which the sync bot doesn't need
+        from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+
+        record = {"method": "sendMessage", "chat_id": chat_id, "attempts": 0, "waited_ms": 0}
+        started = time.perf_counter()
+        try:
+            for _ in range(MAX_ATTEMPTS):
+                delay = self._reserve(chat_id)
+                if delay is None:
+                    record["result"] = "limited"
+                    return False
+                if delay:
+                    await asyncio.sleep(delay)
+                    record["waited_ms"] += tracing.ms(delay)
+                record["attempts"] += 1
+                try:
+                    await self.bot.send_message(
+                        chat_id=chat_id,
+                        text=text,
+                        parse_mode=parse_mode,
+                        disable_notification=disable_notification,
+                    )
+                    record["result"] = "sent"
+                    return True
+                except AsyncApiTelegramException as e:
+                    if e.error_code != 429:
+                        record["result"] = "error {}".format(e.error_code)
+                        raise
+                    retry_after = e.result_json.get("parameters", {}).get("retry_after", 1)
+                    logger.warning("429 for chat %s, retry after %s s", chat_id, retry_after)
+                    self._backoff(chat_id, retry_after)
+            record["result"] = "limited"
+            return False
+        finally:
+            record["ms"] = tracing.ms(time.perf_counter() - started)
+            tracing.record_send(record)
+
+    async def send(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        if not await self.try_send(chat_id, text, disable_notification, parse_mode):
+            await self.enqueue(chat_id, text, disable_notification, parse_mode)
+            tracing.annotate(queued=True)
+
+    async def enqueue(self, chat_id, text, disable_notification=True, parse_mode="HTML"):
+        now = int(time.time())
+
+        async def callee(session):
+            await queries.execute_async(
+                session,
+                session.transaction(),
+                queries.ENQUEUE_OUTBOX_MESSAGE,
+                {
+                    "$created_at": now,
+                    "$message_id": str(uuid.uuid4()),
+                    "$chat_id": chat_id,
+                    "$text": text,
+                    "$parse_mode": parse_mode,
+                    "$disable_notification": disable_notification,
+                    "$next_attempt": now,
+                },
+                commit_tx=True,
+            )
+
+        pool = await self.get_pool()
+        return await pool.retry_operation(callee)
@@ -0,0 +1,29 @@
+import logging
+import telebot
+import os
+from dotenv import load_dotenv
+from database import get_pool
+import tracing
+from outbox import Outbox
+
+# init
+load_dotenv()
+logger = telebot.logger
+telebot.logger.setLevel(logging.INFO)
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')
+bot = telebot.TeleBot(os.getenv('TELEGRAM_TOKEN'),
+                      threaded=False, parse_mode="HTML")
+
+outbox = Outbox(bot, get_pool)
+
+
+def handler(event, context):
+    # Timer trigger: sends messages queued by the rate limiter
+    tracing.start('outbox_worker', event)
+    sent = outbox.drain()
+    tracing.annotate(sent=sent)
+    tracing.finish()
+    return {
+        'statusCode': 200,
+    }
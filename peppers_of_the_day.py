@@ -1,109 +1,105 @@
 import logging
 import telebot
 import os
-import ydb
-import ydb.iam
-from datetime import datetime
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from database import get_pool
+import tracing
+from outbox import Outbox
+from repository import (
+    compact_global_top,
+    day_of,
+    draw_peppers_of_the_day,
+    get_peppers_of_the_day,
+    midnight_timezones,
+    save_peppers_of_the_day,
+    today,
+)
+from templates import render
 
 # init
 load_dotenv()
 logger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
+if os.getenv('TELEGRAM_API_URL'):
+    telebot.apihelper.API_URL = os.getenv('TELEGRAM_API_URL')
 bot = telebot.TeleBot(os.getenv('TELEGRAM_TOKEN'),
                       threaded=False, parse_mode="HTML")
 
-# Create driver in global space.
-driver = ydb.Driver(
-    endpoint=os.getenv('YDB_ENDPOINT'),
-    database=os.getenv('YDB_DATABASE'),
-    credentials=ydb.iam.MetadataUrlCredentials(),
-)
-# Wait for the driver to become active for requests.
-driver.wait(fail_fast=True, timeout=5)
-# Create the session pool instance to manage YDB sessions.
-pool = ydb.SessionPool(driver)
+outbox = Outbox(bot, get_pool)
+
+
+DRAW_CHUNK_SIZE = 100
+SEND_WORKERS = 8
 
 
+# Runs every hour at minute 0. Each run draws the chats whose timezone has
+# just passed midnight, so the draws and announcements are spread over the
+# day instead of all chats at once. Chats already drawn today are skipped,
+# a rerun doesn't announce twice.
 def handler(event, context):
     # Main handler
-    peppers_of_the_day = get_peppers_of_the_day()
-    if peppers_of_the_day:
-        for pepper_of_the_day in peppers_of_the_day:
-            random_pepper = get_random_pepper(pepper_of_the_day.chat_id)
-            update_pepper_of_the_day(
-                random_pepper.chat_id, random_pepper.user_id)
-
-            bot.send_message(
-                chat_id=pepper_of_the_day.chat_id,
-                text="<b>@{0}</b>, поздравляю! У тебя сегодня самый лучший перчик!".format(
-                    random_pepper.username),
-                parse_mode="HTML",
-                disable_notification=True
-            )
+    tracing.start('peppers_of_the_day', event)
+    timezones = midnight_timezones()
+    chats = 0
+    with ThreadPoolExecutor(max_workers=SEND_WORKERS) as executor:
+        for timezone in timezones:
+            day = today(timezone)
+            for chunk in chunks(get_peppers_of_the_day(timezone), DRAW_CHUNK_SIZE):
+                chat_ids = [pepper_of_the_day.chat_id
+                            for pepper_of_the_day in chunk
+                            if day_of(pepper_of_the_day, timezone) < day]
+                if not chat_ids:
+                    continue
+                chats += len(chat_ids)
+                try:
+                    with tracing.stage('draw'):
+                        winners = draw_peppers_of_the_day(chat_ids, day)
+                        save_peppers_of_the_day(winners, day)
+                except Exception:
+                    # a failed chunk must not stop the draw in other chats
+                    logger.exception('Draw failed for chats %s', chat_ids)
+                    continue
+                for winner in winners:
+                    # copy the context so the sends are recorded in the trace
+                    executor.submit(contextvars.copy_context().run,
+                                    announce_pepper_of_the_day, winner)
+    tracing.annotate(timezones=len(timezones), chats=chats)
+    try:
+        with tracing.stage('compact_global_top'):
+            compact_global_top()
+    except Exception:
+        logger.exception('Global top compaction failed')
+    tracing.finish()
 
     return {
         'statusCode': 200,
     }
 
-# Yandex Database Operations
-
 
-def get_random_pepper(chat_id):
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT * 
-            FROM `peppers` 
-            WHERE chat_id = {} 
-            ORDER BY RANDOM(pepper_id) 
-            LIMIT 1
-            """.format(chat_id),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings().with_timeout(3).with_operation_timeout(2)
-        )
-        if result_sets[0].rows:
-            return result_sets[0].rows[0]
-        else:
-            return False
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    return pool.retry_operation_sync(callee)
 
-
-def update_pepper_of_the_day(chat_id, user_id):
-    last_updated = int(datetime.timestamp(datetime.now()))
-
-    def callee(session):
-        session.transaction().execute(
-            """
-            UPDATE `peppers_of_the_day`
-            SET user_id = {0}, last_updated = {1}
-            WHERE chat_id = {2};
-            """.format(user_id, last_updated, chat_id),
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings().with_timeout(3).with_operation_timeout(2)
-        )
-    return pool.retry_operation_sync(callee)
-
-
-def get_peppers_of_the_day():
-    def callee(session):
-        result_sets = session.transaction().execute(
-            """
-            SELECT *
-            FROM peppers_of_the_day;
-            """,
-            commit_tx=True,
-            settings=ydb.BaseRequestSettings().with_timeout(3).with_operation_timeout(2)
+def announce_pepper_of_the_day(winner):
+    try:
+        outbox.send(
+            winner.chat_id,
+            render('pepper_of_the_day', username=winner.username),
+            disable_notification=True
         )
-        if result_sets[0].rows:
-            return result_sets[0].rows
-        else:
-            return False
-
-    return pool.retry_operation_sync(callee)
+    except Exception:
+        logger.exception('Announcement failed for chat %s', winner.chat_id)
 
 
-if os.getenv("LAMBDA_RUNTIME_DIR") is None:
+if __name__ == "__main__" and os.getenv("LAMBDA_RUNTIME_DIR") is None:
     from faker import event, context
     handler(event, context)
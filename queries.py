@@ -0,0 +1,556 @@
+import time
+import tracing
+from database import OPERATION_TIMEOUT, QUERY_TIMEOUT
+
+# YQL statements shared by repository.py, main_async.py and the workers.
+# Every statement declares its parameters, so the query text never changes
+# between calls and YDB can reuse the compiled plan.
+
+# Place is "number of peppers in the chat with a larger size" plus one.
+# It is read from the idx_chat_size index (see create_table.py), which
+# is sorted by (chat_id, size), so the lookup seeks straight to the chat
+# instead of ranking every pepper in it.
+GET_PEPPER = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_id AS Int64;
+
+$size = (SELECT size FROM `peppers` WHERE chat_id = $chat_id AND user_id = $user_id);
+$place = (
+    SELECT COUNT(*) + 1
+    FROM `peppers` VIEW idx_chat_size
+    WHERE chat_id = $chat_id AND size > $size
+);
+
+SELECT p.*, $place AS place
+FROM `peppers` AS p
+WHERE chat_id = $chat_id AND user_id = $user_id;
+"""
+
+# The size a pepper has to beat to enter the global top (the
+# $global_top_size-th one, none while the top isn't full). Grows read it
+# outside their transaction through a cache (see
+# repository.global_top_threshold): a range read of `global_top` in every
+# grow would be invalidated by any grow that enters the top. A stale
+# threshold only adds rows the compaction drops.
+GET_GLOBAL_TOP_THRESHOLD = """
+DECLARE $global_top_size AS Uint64;
+
+SELECT size
+FROM `global_top`
+ORDER BY size DESC
+LIMIT 1 OFFSET $global_top_size - 1ul;
+"""
+
+# First half of grow_pepper_transaction: the pepper with its place, the
+# current chat leader, the statistics rows the grow updates and whether the
+# user is in the global top, whose row then follows the size either way.
+# The first four are also all the state the game rules can ask for
+# (rules.CONDITIONS).
+GROW_READ = GET_PEPPER + """
+SELECT user_id
+FROM `peppers` VIEW idx_chat_size
+WHERE chat_id = $chat_id
+ORDER BY size DESC
+LIMIT 1;
+
+SELECT *
+FROM `pepper_stats`
+WHERE chat_id = $chat_id AND user_id = $user_id;
+
+SELECT grows, total_growth, timezone
+FROM `chats`
+WHERE chat_id = $chat_id;
+
+SELECT user_id
+FROM `global_top`
+WHERE chat_id = $chat_id AND user_id = $user_id;
+"""
+
+# History and statistics written with every grow: one row per grow in the
+# append-only `pepper_events`, and running totals in `pepper_stats` (per
+# user) and `chats` (per chat), computed by repository.grow_stats. /stats reads
+# only the totals. $global_top holds the peppers that are in the global
+# top after the grow, usually none.
+DECLARE_GROWTH = """
+DECLARE $events AS List<Struct<
+    chat_id: Int64,
+    user_id: Int64,
+    created_at: Int64,
+    grow: Int64,
+    bonus: Utf8?,
+    size: Int64
+>>;
+DECLARE $stats AS List<Struct<
+    chat_id: Int64,
+    user_id: Int64,
+    grows: Int64,
+    total_growth: Int64,
+    streak: Int64,
+    best_streak: Int64,
+    last_day: Int64,
+    bonuses: Utf8
+>>;
+DECLARE $chat_grows AS Int64?;
+DECLARE $chat_total_growth AS Int64;
+DECLARE $global_top AS List<Struct<chat_id: Int64, user_id: Int64, username: Utf8?, size: Int64>>;
+"""
+
+RECORD_GROWTH = """
+UPSERT INTO `pepper_events`
+SELECT * FROM AS_TABLE($events);
+
+UPSERT INTO `pepper_stats`
+SELECT * FROM AS_TABLE($stats);
+
+UPSERT INTO `chats` (chat_id, grows, total_growth)
+VALUES ($chat_id, $chat_grows, $chat_total_growth);
+
+UPSERT INTO `global_top`
+SELECT * FROM AS_TABLE($global_top);
+"""
+
+# Second half of grow_pepper_transaction: the new place and the write.
+GROW_WRITE = DECLARE_GROWTH + """
+DECLARE $pepper_id AS Utf8;
+DECLARE $chat_id AS Int64;
+DECLARE $user_id AS Int64;
+DECLARE $username AS Utf8?;
+DECLARE $size AS Int64;
+DECLARE $last_updated AS Int64;
+DECLARE $day AS Int64;
+
+SELECT COUNT(*) + 1 AS place
+FROM `peppers` VIEW idx_chat_size
+WHERE chat_id = $chat_id AND user_id != $user_id AND size > $size;
+
+UPSERT INTO `peppers` (pepper_id, chat_id, user_id, username, size, last_updated, day)
+VALUES ($pepper_id, $chat_id, $user_id, $username, $size, $last_updated, $day);
+""" + RECORD_GROWTH
+
+# Batched grow for server.py: all /pepper calls of one chat in a
+# micro-batch share one read and one write.
+GROW_BATCH_READ = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_ids AS List<Int64>;
+
+SELECT *
+FROM `peppers`
+WHERE chat_id = $chat_id AND user_id IN $user_ids;
+
+SELECT user_id
+FROM `peppers` VIEW idx_chat_size
+WHERE chat_id = $chat_id
+ORDER BY size DESC
+LIMIT 1;
+
+SELECT *
+FROM `pepper_stats`
+WHERE chat_id = $chat_id AND user_id IN $user_ids;
+
+SELECT grows, total_growth, timezone
+FROM `chats`
+WHERE chat_id = $chat_id;
+
+SELECT user_id
+FROM `global_top`
+WHERE chat_id = $chat_id AND user_id IN $user_ids;
+"""
+
+# GROW_BATCH_READ plus the place of every batch user's pepper before the
+# grow, for game rules that look at it (see rules.py). The places are
+# counted here like in GET_PEPPER: the peppers above the smallest one of the
+# batch are one range read of the index, and only a row per batch user comes
+# back, so a big chat doesn't run into the 1000 row limit. Users without a
+# row have the first place, new users have no pepper and no place.
+GROW_BATCH_READ_PLACES = GROW_BATCH_READ + """
+$batch = (
+    SELECT user_id, size
+    FROM `peppers`
+    WHERE chat_id = $chat_id AND user_id IN $user_ids
+);
+$min_size = (SELECT MIN(size) FROM $batch);
+
+SELECT b.user_id AS user_id, COUNT(*) + 1 AS place
+FROM $batch AS b
+CROSS JOIN (
+    SELECT size
+    FROM `peppers` VIEW idx_chat_size
+    WHERE chat_id = $chat_id AND size > $min_size
+) AS o
+WHERE o.size > b.size
+GROUP BY b.user_id;
+"""
+
+# Counts for every batch user how many peppers outside the batch are bigger
+# than its new size in $sizes, the caller adds the batch users above it.
+# Users without a row have none above them.
+GROW_BATCH_WRITE = DECLARE_GROWTH + """
+DECLARE $chat_id AS Int64;
+DECLARE $min_size AS Int64;
+DECLARE $sizes AS List<Struct<user_id: Int64, size: Int64>>;
+DECLARE $peppers AS List<Struct<
+    pepper_id: Utf8,
+    chat_id: Int64,
+    user_id: Int64,
+    username: Utf8?,
+    size: Int64,
+    last_updated: Int64,
+    day: Int64
+>>;
+
+$others = (
+    SELECT p.size AS size
+    FROM `peppers` VIEW idx_chat_size AS p
+    LEFT ONLY JOIN AS_TABLE($sizes) AS b ON b.user_id = p.user_id
+    WHERE p.chat_id = $chat_id AND p.size > $min_size
+);
+
+SELECT s.user_id AS user_id, COUNT(*) AS above
+FROM AS_TABLE($sizes) AS s
+CROSS JOIN $others AS o
+WHERE o.size > s.size
+GROUP BY s.user_id;
+
+UPSERT INTO `peppers`
+SELECT * FROM AS_TABLE($peppers);
+""" + RECORD_GROWTH
+
+# Random draws don't rank the chat. Every pepper gets a dense position
+# 0..participants-1 in `chat_participants` when it is created, so a draw is
+# a random position and a point read, whatever the size of the chat. The
+# random numbers in [0, 1) come from the caller in $draws, one candidate
+# each.
+ADD_PARTICIPANTS = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_ids AS List<Int64>;
+
+$participants = (SELECT participants FROM `chats` WHERE chat_id = $chat_id) ?? 0ul;
+
+UPSERT INTO `chats` (chat_id, participants)
+VALUES ($chat_id, $participants + ListLength($user_ids));
+
+UPSERT INTO `chat_participants`
+SELECT * FROM AS_TABLE(ListMap(ListEnumerate($user_ids), ($user) -> (
+    AsStruct($chat_id AS chat_id, $participants + $user.0 AS seq, $user.1 AS user_id)
+)));
+"""
+
+GET_RANDOM_PEPPER = """
+DECLARE $chat_id AS Int64;
+DECLARE $draws AS List<Double>;
+
+$participants = (SELECT participants FROM `chats` WHERE chat_id = $chat_id);
+$seqs = ListMap($draws, ($draw) -> (
+    AsStruct($chat_id AS chat_id, MIN_OF(CAST($draw * $participants AS Uint64), $participants - 1ul) AS seq)
+));
+
+SELECT p.*
+FROM AS_TABLE($seqs) AS s
+JOIN `chat_participants` AS m ON m.chat_id = s.chat_id AND m.seq = s.seq
+JOIN `peppers` AS p ON p.chat_id = m.chat_id AND p.user_id = m.user_id;
+"""
+
+# Weighted by size: the candidates plus the leader's size, see
+# repository.pick_random_pepper.
+GET_WEIGHTED_RANDOM_PEPPER = GET_RANDOM_PEPPER + """
+SELECT size
+FROM `peppers` VIEW idx_chat_size
+WHERE chat_id = $chat_id
+ORDER BY size DESC
+LIMIT 1;
+"""
+
+GET_STATS = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_id AS Int64;
+
+SELECT *
+FROM `pepper_stats`
+WHERE chat_id = $chat_id AND user_id = $user_id;
+
+SELECT participants, grows, total_growth, timezone
+FROM `chats`
+WHERE chat_id = $chat_id;
+"""
+
+GET_TOP_PEPPERS = """
+DECLARE $chat_id AS Int64;
+
+SELECT chat_id, user_id, username, size
+FROM `peppers` VIEW idx_chat_size
+WHERE chat_id = $chat_id
+ORDER BY size DESC
+LIMIT 10;
+"""
+
+# Leaderboard across all chats. Grows that beat the GLOBAL_TOP_SIZE-th
+# size add their pepper to `global_top` (see
+# repository.global_top_entries), so reading it never sorts `peppers`.
+# COMPACT_GLOBAL_TOP trims the rows that fell out of the top, the table
+# stays small in between.
+GET_GLOBAL_TOP = """
+DECLARE $limit AS Uint64;
+
+SELECT chat_id, user_id, username, size
+FROM `global_top`
+ORDER BY size DESC
+LIMIT $limit;
+"""
+
+COMPACT_GLOBAL_TOP = """
+DECLARE $limit AS Uint64;
+
+$keep = (
+    SELECT chat_id, user_id
+    FROM `global_top`
+    ORDER BY size DESC
+    LIMIT $limit
+);
+
+DELETE FROM `global_top` ON
+SELECT g.chat_id AS chat_id, g.user_id AS user_id
+FROM `global_top` AS g
+LEFT ONLY JOIN $keep AS k ON g.chat_id = k.chat_id AND g.user_id = k.user_id;
+"""
+
+# The pepper of the day and the timezone of the chat it belongs to.
+GET_PEPPER_OF_THE_DAY = """
+DECLARE $chat_id AS Int64;
+
+SELECT *
+FROM `peppers_of_the_day`
+WHERE chat_id = $chat_id;
+
+SELECT timezone
+FROM `chats`
+WHERE chat_id = $chat_id;
+"""
+
+# Page of the keyset pagination over the chats of one timezone, see
+# paginate(). A NULL $timezone selects the chats that never set one. The
+# idx_timezone index of `chats` is sorted by (timezone, chat_id), so a page
+# is a range read.
+GET_PEPPERS_OF_THE_DAY = """
+DECLARE $timezone AS Utf8?;
+DECLARE $after AS Int64;
+DECLARE $limit AS Uint64;
+
+SELECT p.*
+FROM `chats` VIEW idx_timezone AS c
+JOIN `peppers_of_the_day` AS p ON p.chat_id = c.chat_id
+WHERE c.timezone IS NOT DISTINCT FROM $timezone AND c.chat_id > $after
+ORDER BY p.chat_id
+LIMIT $limit;
+"""
+
+SET_CHAT_TIMEZONE = """
+DECLARE $chat_id AS Int64;
+DECLARE $timezone AS Utf8;
+
+UPSERT INTO `chats` (chat_id, timezone)
+VALUES ($chat_id, $timezone);
+"""
+
+# GET_RANDOM_PEPPER for a chunk of chats, one draw per chat.
+DRAW_PEPPERS_OF_THE_DAY = """
+DECLARE $draws AS List<Struct<chat_id: Int64, draw: Double>>;
+
+$seqs = (
+    SELECT d.chat_id AS chat_id, MIN_OF(CAST(d.draw * c.participants AS Uint64), c.participants - 1ul) AS seq
+    FROM AS_TABLE($draws) AS d
+    JOIN `chats` AS c ON c.chat_id = d.chat_id
+);
+
+SELECT p.chat_id AS chat_id, p.user_id AS user_id, p.username AS username
+FROM $seqs AS s
+JOIN `chat_participants` AS m ON m.chat_id = s.chat_id AND m.seq = s.seq
+JOIN `peppers` AS p ON p.chat_id = m.chat_id AND p.user_id = m.user_id;
+"""
+
+SAVE_PEPPERS_OF_THE_DAY = """
+DECLARE $peppers_of_the_day AS List<Struct<chat_id: Int64, user_id: Int64, last_updated: Int64, day: Int64>>;
+
+UPSERT INTO `peppers_of_the_day`
+SELECT chat_id, user_id, last_updated, day FROM AS_TABLE($peppers_of_the_day);
+"""
+
+CREATE_PEPPER_OF_THE_DAY = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_id AS Int64;
+DECLARE $last_updated AS Int64;
+DECLARE $day AS Int64;
+
+UPSERT INTO `peppers_of_the_day` (chat_id, user_id, last_updated, day)
+VALUES ($chat_id, $user_id, $last_updated, $day);
+"""
+
+UPDATE_PEPPER_OF_THE_DAY = """
+DECLARE $chat_id AS Int64;
+DECLARE $user_id AS Int64;
+DECLARE $last_updated AS Int64;
+DECLARE $day AS Int64;
+
+UPDATE `peppers_of_the_day`
+SET user_id = $user_id, last_updated = $last_updated, day = $day
+WHERE chat_id = $chat_id;
+"""
+
+
+# Persistent queue of messages the outbox could not send within the rate
+# limits, drained by outbox_worker.py.
+ENQUEUE_OUTBOX_MESSAGE = """
+DECLARE $created_at AS Int64;
+DECLARE $message_id AS Utf8;
+DECLARE $chat_id AS Int64;
+DECLARE $text AS Utf8;
+DECLARE $parse_mode AS Utf8?;
+DECLARE $disable_notification AS Bool;
+DECLARE $next_attempt AS Int64;
+
+UPSERT INTO `outbox` (created_at, message_id, chat_id, text, parse_mode, disable_notification, next_attempt)
+VALUES ($created_at, $message_id, $chat_id, $text, $parse_mode, $disable_notification, $next_attempt);
+"""
+
+GET_DUE_OUTBOX_MESSAGES = """
+DECLARE $now AS Int64;
+DECLARE $limit AS Uint64;
+
+SELECT *
+FROM `outbox`
+WHERE next_attempt <= $now
+ORDER BY created_at
+LIMIT $limit;
+"""
+
+DELETE_OUTBOX_MESSAGE = """
+DECLARE $created_at AS Int64;
+DECLARE $message_id AS Utf8;
+
+DELETE FROM `outbox`
+WHERE created_at = $created_at AND message_id = $message_id;
+"""
+
+RESCHEDULE_OUTBOX_MESSAGE = """
+DECLARE $created_at AS Int64;
+DECLARE $message_id AS Utf8;
+DECLARE $next_attempt AS Int64;
+
+UPDATE `outbox`
+SET next_attempt = $next_attempt
+WHERE created_at = $created_at AND message_id = $message_id;
+"""
+
+
+# statement text -> constant name, for tracing
+NAMES = {
+    value: name for name, value in list(globals().items())
+    if name.isupper() and isinstance(value, str)
+}
+
+
+# Data queries return at most 1000 rows, larger results are truncated.
+PAGE_SIZE = 1000
+# $after of the first page for Int64 keys
+FIRST_KEY = -2 ** 63
+
+
+def settings():
+    import ydb
+
+    request_settings = (
+        ydb.ExecDataQuerySettings()
+        .with_keep_in_cache(True)
+        .with_timeout(QUERY_TIMEOUT)
+        .with_operation_timeout(OPERATION_TIMEOUT)
+    )
+    # lets the YDB side logs be matched with the webhook request
+    if tracing.trace_id():
+        request_settings = request_settings.with_trace_id(tracing.trace_id())
+    return request_settings
+
+
+def execute(session, tx, query, parameters=None, commit_tx=False):
+    # session.prepare compiles the statement once per session and returns
+    # the cached prepared query on later calls.
+    started = time.perf_counter()
+    prepared = session.prepare(query, settings())
+    result_sets = tx.execute(prepared, parameters, commit_tx=commit_tx, settings=settings())
+    tracing.record_statement(
+        NAMES.get(query, "query"),
+        time.perf_counter() - started,
+        sum(len(result_set.rows) for result_set in result_sets or ()),
+    )
+    return result_sets
+
+
+async def execute_async(session, tx, query, parameters=None, commit_tx=False):
+    # execute() for ydb.aio sessions
+    started = time.perf_counter()
+    prepared = await session.prepare(query, settings())
+    result_sets = await tx.execute(prepared, parameters, commit_tx=commit_tx, settings=settings())
+    tracing.record_statement(
+        NAMES.get(query, "query"),
+        time.perf_counter() - started,
+        sum(len(result_set.rows) for result_set in result_sets or ()),
+    )
+    return result_sets
+
+
+def run(session, steps, tx_mode=None):
+    # Runs a step generator of repository.py in a transaction of
+    # `session`. The generator yields (query, parameters, commit_tx) for
+    # every statement and gets its result sets back, what it returns is the
+    # result. A transaction it leaves open is committed at the end.
+    tx = session.transaction(tx_mode)
+    result_sets = None
+    pending = False
+    while True:
+        try:
+            query, parameters, commit_tx = steps.send(result_sets)
+        except StopIteration as stop:
+            if pending:
+                tx.commit()
+            return stop.value
+        result_sets = execute(session, tx, query, parameters, commit_tx)
+        pending = not commit_tx
+
+
+async def run_async(session, steps, tx_mode=None):
+    # run() for ydb.aio sessions, main_async.py runs the same generators
+    tx = session.transaction(tx_mode)
+    result_sets = None
+    pending = False
+    while True:
+        try:
+            query, parameters, commit_tx = steps.send(result_sets)
+        except StopIteration as stop:
+            if pending:
+                await tx.commit()
+            return stop.value
+        result_sets = await execute_async(session, tx, query, parameters, commit_tx)
+        pending = not commit_tx
+
+
+def paginate(pool, query, parameters, next_page, page_size=PAGE_SIZE):
+    # Yields all rows of a keyset-paginated query, one page per round-trip,
+    # without holding more than a page in memory. The query takes $limit
+    # and returns rows in key order; `parameters` selects the first page
+    # and next_page(last_row) returns the parameters of the next one.
+    import ydb
+
+    while True:
+        def callee(session):
+            result_sets = execute(
+                session,
+                session.transaction(ydb.OnlineReadOnly()),
+                query,
+                dict(parameters, **{"$limit": page_size}),
+                commit_tx=True,
+            )
+            return result_sets[0].rows
+
+        rows = pool.retry_operation_sync(callee)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        parameters = next_page(rows[-1])
@@ -0,0 +1,601 @@
+from datetime import datetime, time, timedelta
+import json
+import os
+import uuid
+from functools import lru_cache
+from zoneinfo import ZoneInfo, available_timezones
+import queries
+from cache import TTLCache
+from database import get_pool
+from rng import draw_stream, grow_stream
+from rules import RULES
+
+# Data access shared by the bot (main.py), the daily draw
+# (peppers_of_the_day.py) and any other worker. Every function runs on the
+# pool from database.get_pool(), whose size, warm sessions and timeouts are
+# configured there. main_async.py has the asyncio counterparts, they run
+# the same step generators (see Steps below).
+
+# Warm-container caches keyed by chat_id, the writers below invalidate them.
+top_peppers_cache = TTLCache(maxsize=1024, ttl=60)
+pepper_of_the_day_cache = TTLCache(maxsize=1024, ttl=600)
+# The GLOBAL_TOP_SIZE biggest peppers of all chats for /global_top and the
+# size a grow has to beat to enter it, see queries.GET_GLOBAL_TOP_THRESHOLD.
+global_top_cache = TTLCache(maxsize=2, ttl=60)
+GLOBAL_TOP_SIZE = 100
+# Candidates per round of a weighted random draw and the rounds before it
+# settles for a uniform pick, see pick_random_pepper.
+WEIGHTED_DRAWS = 8
+WEIGHTED_ROUNDS = 16
+# Timezone of the chats that didn't set one with /timezone, the local time
+# of the container if unset.
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE")
+# pepper_stats columns of the bonus counts before `bonuses`, see bonus_counts
+LEGACY_BONUS_COLUMNS = ("double_increase", "curse_of_the_first")
+
+
+def get_pepper(chat_id, user_id):
+    def callee(session):
+        return queries.run(session, get_pepper_steps(chat_id, user_id))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def grow_pepper_transaction(chat_id, user_id, username):
+    threshold = global_top_threshold()
+
+    def callee(session):
+        return queries.run(session, grow_pepper_steps(chat_id, user_id, username, threshold))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def get_random_pepper(chat_id, day, weighted=False):
+    def callee(session):
+        return queries.run(session, random_pepper_steps(chat_id, day, weighted))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def get_stats(chat_id, user_id):
+    def callee(session):
+        return queries.run(session, stats_steps(chat_id, user_id))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def get_top_peppers(chat_id):
+    top_peppers = top_peppers_cache.get(chat_id)
+    if top_peppers is not None:
+        return top_peppers
+
+    def callee(session):
+        return queries.run(session, top_peppers_steps(chat_id))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def get_global_top():
+    global_top = global_top_cache.get("global")
+    if global_top is not None:
+        return global_top
+
+    def callee(session):
+        import ydb
+
+        # no locks, grows writing to global_top never wait for this read
+        return queries.run(session, global_top_steps(), ydb.OnlineReadOnly())
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def global_top_threshold():
+    threshold = global_top_cache.get("threshold")
+    if threshold is not None:
+        return threshold
+
+    def callee(session):
+        import ydb
+
+        # no locks, like get_global_top
+        return queries.run(session, global_top_threshold_steps(), ydb.OnlineReadOnly())
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def get_pepper_of_the_day(chat_id):
+    # (pepper of the day or False, timezone of the chat)
+    cached = pepper_of_the_day_cache.get(chat_id)
+    if cached is not None:
+        return cached
+
+    def callee(session):
+        return queries.run(session, pepper_of_the_day_steps(chat_id))
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def create_pepper_of_the_day(chat_id, user_id, day):
+    def callee(session):
+        return queries.run(
+            session, write_pepper_of_the_day_steps(queries.CREATE_PEPPER_OF_THE_DAY, chat_id, user_id, day)
+        )
+
+    get_pool().retry_operation_sync(callee)
+
+
+def update_pepper_of_the_day(chat_id, user_id, day):
+    def callee(session):
+        return queries.run(
+            session, write_pepper_of_the_day_steps(queries.UPDATE_PEPPER_OF_THE_DAY, chat_id, user_id, day)
+        )
+
+    get_pool().retry_operation_sync(callee)
+
+
+def set_chat_timezone(chat_id, timezone):
+    def callee(session):
+        return queries.run(session, chat_timezone_steps(chat_id, timezone))
+
+    get_pool().retry_operation_sync(callee)
+
+
+def draw_peppers_of_the_day(chat_ids, day):
+    # Picks the random pepper of `day` in every given chat with one query, a
+    # point read per chat (see queries.GET_RANDOM_PEPPER).
+    draws = [{"chat_id": chat_id, "draw": draw_stream(chat_id, day).random()} for chat_id in chat_ids]
+
+    def callee(session):
+        import ydb
+
+        result_sets = queries.execute(
+            session,
+            session.transaction(ydb.OnlineReadOnly()),
+            queries.DRAW_PEPPERS_OF_THE_DAY,
+            {"$draws": draws},
+            commit_tx=True,
+        )
+        return result_sets[0].rows
+
+    return get_pool().retry_operation_sync(callee)
+
+
+def save_peppers_of_the_day(winners, day):
+    last_updated = int(datetime.timestamp(datetime.now()))
+
+    def callee(session):
+        queries.execute(
+            session,
+            session.transaction(),
+            queries.SAVE_PEPPERS_OF_THE_DAY,
+            {
+                "$peppers_of_the_day": [
+                    {"chat_id": winner.chat_id, "user_id": winner.user_id, "last_updated": last_updated, "day": day}
+                    for winner in winners
+                ]
+            },
+            commit_tx=True,
+        )
+
+    if winners:
+        get_pool().retry_operation_sync(callee)
+    for winner in winners:
+        pepper_of_the_day_cache.invalidate(winner.chat_id)
+
+
+def get_peppers_of_the_day(timezone):
+    # Streams the chats of a timezone (None for DEFAULT_TIMEZONE) page by
+    # page, so full-table jobs don't stop at the 1000 row limit of a single
+    # query.
+    return queries.paginate(
+        get_pool(),
+        queries.GET_PEPPERS_OF_THE_DAY,
+        {"$timezone": timezone, "$after": queries.FIRST_KEY},
+        lambda last: {"$timezone": timezone, "$after": last.chat_id},
+    )
+
+
+def compact_global_top():
+    # Drops the peppers that fell out of the global top.
+    def callee(session):
+        queries.execute(
+            session,
+            session.transaction(),
+            queries.COMPACT_GLOBAL_TOP,
+            {"$limit": GLOBAL_TOP_SIZE},
+            commit_tx=True,
+        )
+
+    get_pool().retry_operation_sync(callee)
+    global_top_cache.invalidate("global")
+    global_top_cache.invalidate("threshold")
+
+
+# Steps
+# The statements of the functions above, shared with main_async.py. Each
+# generator yields (query, parameters, commit_tx), gets the result sets
+# back and returns the result, queries.run() or queries.run_async()
+# executes it in one transaction. A retry starts a new generator.
+def get_pepper_steps(chat_id, user_id):
+    result_sets = yield queries.GET_PEPPER, {"$chat_id": chat_id, "$user_id": user_id}, True
+    return result_sets[0].rows[0] if result_sets[0].rows else False
+
+
+def grow_pepper_steps(chat_id, user_id, username, threshold):
+    # Reads the pepper with the state the game rules need, grows it by
+    # rules.RULES and calculates its new place in one serializable
+    # transaction (two round-trips). Days start at midnight in the chat's
+    # timezone. `threshold` is the size to beat to enter the global top,
+    # from global_top_threshold().
+    # A concurrent /pepper for the same user aborts on commit and is retried
+    # by the pool, so it sees the already updated row.
+    result_sets = yield queries.GROW_READ, {"$chat_id": chat_id, "$user_id": user_id}, False
+    pepper = result_sets[0].rows[0] if result_sets[0].rows else None
+    leader = result_sets[1].rows[0] if result_sets[1].rows else None
+    stats = result_sets[2].rows[0] if result_sets[2].rows else None
+    chat = result_sets[3].rows[0] if result_sets[3].rows else None
+    in_global_top = {row.user_id for row in result_sets[4].rows}
+
+    timezone = chat.timezone if chat else None
+    day = today(timezone)
+    if pepper and day_of(pepper, timezone) >= day:
+        # pepper already updated today
+        return {
+            "is_repeat": True,
+            "size": pepper.size,
+            "place": pepper.place,
+            "grow": None,
+            "timezone": timezone,
+        }
+
+    grow = RULES.grow(grow_state(user_id, pepper, leader, stats, day), grow_stream(chat_id, user_id, day))
+    grow_size = grow["bonus"]["size"] if grow["bonus"] else grow["size"]
+    new_size = pepper.size + grow_size if pepper else grow_size
+
+    if pepper is None:
+        # first pepper of this user in the chat, index it for draws
+        yield queries.ADD_PARTICIPANTS, {"$chat_id": chat_id, "$user_ids": [user_id]}, False
+    last_updated = int(datetime.timestamp(datetime.now()))
+    result_sets = yield queries.GROW_WRITE, {
+        "$pepper_id": pepper.pepper_id if pepper else str(uuid.uuid4()),
+        "$chat_id": chat_id,
+        "$user_id": user_id,
+        "$username": username,
+        "$size": new_size,
+        "$last_updated": last_updated,
+        "$day": day,
+        "$events": [growth_event(chat_id, user_id, grow, new_size, last_updated)],
+        "$stats": [grow_stats(stats, chat_id, user_id, grow, day)],
+        "$chat_grows": chat_grows(chat, 1),
+        "$chat_total_growth": (chat and chat.total_growth or 0) + grow_size,
+        "$global_top": global_top_entries(
+            [{"chat_id": chat_id, "user_id": user_id, "username": username, "size": new_size}],
+            threshold,
+            in_global_top,
+        ),
+    }, True
+    top_peppers_cache.invalidate(chat_id)
+    return {
+        "is_repeat": False,
+        "size": new_size,
+        "place": result_sets[0].rows[0].place,
+        "grow": grow,
+        "timezone": timezone,
+    }
+
+
+def grow_peppers_batch_steps(chat_id, users, threshold):
+    # grow_pepper_steps for many users of one chat: one read of their
+    # peppers and the leader, one write, places counted from one index read.
+    # `users` maps user_id to username.
+    result_sets = yield (
+        queries.GROW_BATCH_READ_PLACES if "place" in RULES.needs else queries.GROW_BATCH_READ,
+        {"$chat_id": chat_id, "$user_ids": list(users)},
+        False,
+    )
+    peppers = {pepper.user_id: pepper for pepper in result_sets[0].rows}
+    leader = result_sets[1].rows[0] if result_sets[1].rows else None
+    stats = {row.user_id: row for row in result_sets[2].rows}
+    chat = result_sets[3].rows[0] if result_sets[3].rows else None
+    in_global_top = {row.user_id for row in result_sets[4].rows}
+    # places before the grow, only read when the rules need them
+    places = {row.user_id: row.place for row in result_sets[5].rows} if len(result_sets) > 5 else {}
+    last_updated = int(datetime.timestamp(datetime.now()))
+    timezone = chat.timezone if chat else None
+    day = today(timezone)
+
+    results = {}
+    writes = []
+    events = []
+    new_stats = []
+    for user_id, username in users.items():
+        pepper = peppers.get(user_id)
+        if pepper and day_of(pepper, timezone) >= day:
+            # pepper already updated today
+            results[user_id] = {"is_repeat": True, "size": pepper.size, "grow": None, "timezone": timezone}
+            continue
+        place = pepper and places.get(user_id, 1)
+        grow = RULES.grow(
+            grow_state(user_id, pepper, leader, stats.get(user_id), day, place),
+            grow_stream(chat_id, user_id, day),
+        )
+        grow_size = grow["bonus"]["size"] if grow["bonus"] else grow["size"]
+        new_size = pepper.size + grow_size if pepper else grow_size
+        writes.append(
+            {
+                "pepper_id": pepper.pepper_id if pepper else str(uuid.uuid4()),
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "username": username,
+                "size": new_size,
+                "last_updated": last_updated,
+                "day": day,
+            }
+        )
+        events.append(growth_event(chat_id, user_id, grow, new_size, last_updated))
+        new_stats.append(grow_stats(stats.get(user_id), chat_id, user_id, grow, day))
+        results[user_id] = {"is_repeat": False, "size": new_size, "grow": grow, "timezone": timezone}
+
+    new_users = [user_id for user_id in results if user_id not in peppers]
+    if new_users:
+        yield queries.ADD_PARTICIPANTS, {"$chat_id": chat_id, "$user_ids": new_users}, False
+    sizes = {user_id: result["size"] for user_id, result in results.items()}
+    result_sets = yield queries.GROW_BATCH_WRITE, {
+        "$chat_id": chat_id,
+        "$min_size": min(sizes.values()),
+        "$sizes": [{"user_id": user_id, "size": size} for user_id, size in sizes.items()],
+        "$peppers": writes,
+        "$events": events,
+        "$stats": new_stats,
+        "$chat_grows": chat_grows(chat, len(events)),
+        "$chat_total_growth": (chat and chat.total_growth or 0) + sum(event["grow"] for event in events),
+        "$global_top": global_top_entries(
+            [{key: write[key] for key in ("chat_id", "user_id", "username", "size")} for write in writes],
+            threshold,
+            in_global_top,
+        ),
+    }, True
+    # the peppers outside the batch above each user, then the batch ones
+    above = {row.user_id: row.above for row in result_sets[0].rows}
+    for user_id, result in results.items():
+        result["place"] = 1 + above.get(user_id, 0) + sum(
+            1 for other, size in sizes.items() if other != user_id and size > result["size"]
+        )
+    if writes:
+        top_peppers_cache.invalidate(chat_id)
+    return results
+
+
+def random_pepper_steps(chat_id, day, weighted=False):
+    # The random pepper of the chat on `day`, uniform or with weighted=True
+    # picked with probability proportional to its size. Point reads only,
+    # see queries.GET_RANDOM_PEPPER.
+    rng = draw_stream(chat_id, day)
+    for _ in range(WEIGHTED_ROUNDS):
+        result_sets = yield (
+            queries.GET_WEIGHTED_RANDOM_PEPPER if weighted else queries.GET_RANDOM_PEPPER,
+            {"$chat_id": chat_id, "$draws": random_draws(rng, weighted)},
+            True,
+        )
+        pepper = pick_random_pepper(result_sets, rng, weighted)
+        if pepper is not None:
+            return pepper
+    # candidates of the last round, in shuffled order
+    return result_sets[0].rows[0]
+
+
+def stats_steps(chat_id, user_id):
+    # The precomputed rows only, see queries.RECORD_GROWTH.
+    result_sets = yield queries.GET_STATS, {"$chat_id": chat_id, "$user_id": user_id}, True
+    return (
+        result_sets[0].rows[0] if result_sets[0].rows else None,
+        result_sets[1].rows[0] if result_sets[1].rows else None,
+    )
+
+
+def top_peppers_steps(chat_id):
+    result_sets = yield queries.GET_TOP_PEPPERS, {"$chat_id": chat_id}, True
+    top_peppers = result_sets[0].rows or False
+    top_peppers_cache.set(chat_id, top_peppers)
+    return top_peppers
+
+
+def global_top_threshold_steps():
+    result_sets = yield queries.GET_GLOBAL_TOP_THRESHOLD, {"$global_top_size": GLOBAL_TOP_SIZE}, True
+    threshold = result_sets[0].rows[0].size if result_sets[0].rows else 0
+    global_top_cache.set("threshold", threshold)
+    return threshold
+
+
+def global_top_steps():
+    result_sets = yield queries.GET_GLOBAL_TOP, {"$limit": GLOBAL_TOP_SIZE}, True
+    global_top_cache.set("global", result_sets[0].rows)
+    return result_sets[0].rows
+
+
+def pepper_of_the_day_steps(chat_id):
+    result_sets = yield queries.GET_PEPPER_OF_THE_DAY, {"$chat_id": chat_id}, True
+    pepper_of_the_day = result_sets[0].rows[0] if result_sets[0].rows else False
+    timezone = result_sets[1].rows[0].timezone if result_sets[1].rows else None
+    # the daily draw replaces it at midnight, don't keep it past that
+    pepper_of_the_day_cache.set(chat_id, (pepper_of_the_day, timezone), ttl=seconds_until_midnight(timezone))
+    return pepper_of_the_day, timezone
+
+
+def write_pepper_of_the_day_steps(query, chat_id, user_id, day):
+    # CREATE_PEPPER_OF_THE_DAY or UPDATE_PEPPER_OF_THE_DAY
+    last_updated = int(datetime.timestamp(datetime.now()))
+    yield query, {"$chat_id": chat_id, "$user_id": user_id, "$last_updated": last_updated, "$day": day}, True
+    pepper_of_the_day_cache.invalidate(chat_id)
+
+
+def chat_timezone_steps(chat_id, timezone):
+    yield queries.SET_CHAT_TIMEZONE, {"$chat_id": chat_id, "$timezone": timezone}, True
+    pepper_of_the_day_cache.invalidate(chat_id)
+
+
+# Utils
+def random_draws(rng, weighted=False):
+    return [rng.random() for _ in range(WEIGHTED_DRAWS if weighted else 1)]
+
+
+def pick_random_pepper(result_sets, rng, weighted=False):
+    # Weighted draws use rejection sampling: a uniform candidate is kept with
+    # probability size / leader size. Returns None when every candidate was
+    # rejected and another round is needed, False when the chat is empty.
+    candidates = result_sets[0].rows
+    if not candidates:
+        return False
+    leader_size = result_sets[1].rows[0].size if weighted else 0
+    # no pepper has grown, or all shrank: nothing to weigh by
+    if leader_size <= 0:
+        return candidates[0]
+    # the rows come back in key order
+    rng.shuffle(candidates)
+    for pepper in candidates:
+        if rng.random() * leader_size < pepper.size:
+            return pepper
+    return None
+
+
+def grow_state(user_id, pepper, leader, stats, day, place=None):
+    # What the conditions in rules.RULES.needs look at, from the grow read.
+    # `place` overrides the one of the pepper row, the batch read counts it
+    # separately.
+    state = {}
+    if "leader" in RULES.needs:
+        state["leader"] = leader is not None and leader.user_id == user_id
+    if "streak" in RULES.needs:
+        state["streak"] = stats.streak if stats and stats.last_day == day - 1 else 0
+    if "place" in RULES.needs:
+        state["place"] = place or (getattr(pepper, "place", None) if pepper else None)
+    return state
+
+
+def growth_event(chat_id, user_id, grow, size, created_at):
+    return {
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "created_at": created_at,
+        "grow": grow["bonus"]["size"] if grow["bonus"] else grow["size"],
+        "bonus": grow["bonus"]["type"] if grow["bonus"] else None,
+        "size": size,
+    }
+
+
+def grow_stats(stats, chat_id, user_id, grow, day):
+    # The pepper_stats row after a grow on `day` (a date ordinal), from the
+    # previous row or None.
+    previous = {
+        column: getattr(stats, column, None) or 0
+        for column in (
+            "grows",
+            "total_growth",
+            "streak",
+            "best_streak",
+            "last_day",
+        )
+    }
+    bonuses = bonus_counts(stats)
+    if grow["bonus"]:
+        bonuses[grow["bonus"]["type"]] = bonuses.get(grow["bonus"]["type"], 0) + 1
+    streak = previous["streak"] + 1 if previous["last_day"] == day - 1 else 1
+    return {
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "grows": previous["grows"] + 1,
+        "total_growth": previous["total_growth"]
+        + (grow["bonus"]["size"] if grow["bonus"] else grow["size"]),
+        "streak": streak,
+        "best_streak": max(streak, previous["best_streak"]),
+        "last_day": day,
+        "bonuses": json.dumps(bonuses, sort_keys=True),
+    }
+
+
+def bonus_counts(stats):
+    # {bonus type: times it applied} of a pepper_stats row or None. Rows
+    # written before the bonuses column have a column per type instead.
+    if stats is None:
+        return {}
+    if getattr(stats, "bonuses", None) is not None:
+        return json.loads(stats.bonuses)
+    return {
+        column: getattr(stats, column)
+        for column in LEGACY_BONUS_COLUMNS
+        if getattr(stats, column, None)
+    }
+
+
+def chat_grows(chat, count):
+    # The chat's number of grows after `count` more. Chats backfilled by
+    # create_table.py add_stats have a total_growth but no count of the grows
+    # it took, their count stays unknown (NULL).
+    if chat and chat.grows is None and chat.total_growth is not None:
+        return None
+    return (chat and chat.grows or 0) + count
+
+
+def global_top_entries(peppers, threshold, members):
+    # The grown peppers to write to `global_top`: those that beat the
+    # threshold and those already in it, so a pepper that shrank isn't
+    # listed with its old size until the compaction.
+    return [pepper for pepper in peppers if pepper["size"] > threshold or pepper["user_id"] in members]
+
+
+def zone(timezone=None):
+    # None for the local time of the container
+    timezone = timezone or DEFAULT_TIMEZONE
+    return ZoneInfo(timezone) if timezone else None
+
+
+def today(timezone=None):
+    # The current day of a chat as a date ordinal, what the `day` columns hold.
+    return datetime.now(zone(timezone)).toordinal()
+
+
+def day_of(row, timezone=None):
+    # Day of a `peppers` or `peppers_of_the_day` row, rows written before the
+    # day column only have last_updated.
+    if row.day is not None:
+        return row.day
+    return datetime.fromtimestamp(row.last_updated, zone(timezone)).toordinal()
+
+
+def seconds_until_midnight(timezone=None):
+    now = datetime.now(zone(timezone))
+    midnight = datetime.combine(now.date() + timedelta(days=1), time(), now.tzinfo)
+    return midnight.timestamp() - now.timestamp()
+
+
+@lru_cache(maxsize=None)
+def timezones():
+    # The IANA names midnight_timezones() draws for. ZoneInfo also loads
+    # aliases like right/Europe/Moscow that aren't in it, a chat set to one
+    # would never be drawn.
+    return frozenset(available_timezones())
+
+
+def valid_timezone(timezone):
+    return timezone in timezones()
+
+
+def timezone_name(timezone=None):
+    return timezone or DEFAULT_TIMEZONE or datetime.now().astimezone().tzname()
+
+
+def midnight_timezones(now=None):
+    # The timezones whose day changed since the previous hourly run, None for
+    # the chats without one when DEFAULT_TIMEZONE is. Comparing dates rather
+    # than looking for hour 0 also catches the days that skip midnight, like
+    # America/Santiago going from 23:00 to 01:00 on its DST change.
+    now = now or datetime.now(ZoneInfo("UTC"))
+    before = now - timedelta(hours=1)
+
+    def new_day(timezone):
+        return now.astimezone(timezone).date() != before.astimezone(timezone).date()
+
+    names = [timezone for timezone in sorted(timezones()) if new_day(ZoneInfo(timezone))]
+    if new_day(zone()):
+        names.append(None)
+    return names
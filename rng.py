@@ -0,0 +1,89 @@
+import hashlib
+import os
+import random
+import sys
+from datetime import date
+
+# Reproducible randomness for the game. Every random outcome comes from a
+# stream keyed by what it is about, e.g. ("grow", chat_id, user_id, day):
+# the n-th value of a stream is BLAKE2b(n) keyed with a hash of RNG_KEY and
+# the stream key, so it is computed in one step and nothing is stored.
+# A retried webhook grows the pepper by the same amount, and a grow or a
+# draw can be recomputed later to settle a dispute:
+#   python rng.py grow <chat_id> <user_id> <YYYY-MM-DD> [leader] [streak] [place]
+#   python rng.py draw <chat_id> <YYYY-MM-DD> <participants>
+# RNG_KEY must stay secret, with it anyone could predict tomorrow's grows.
+# Without it every process makes up its own key, the values are then random
+# but not reproducible.
+
+FALLBACK_KEY = os.urandom(64)
+
+
+def secret():
+    # read on use, the bot loads .env after importing its modules
+    key = os.getenv("RNG_KEY")
+    return hashlib.blake2b(key.encode()).digest() if key else FALLBACK_KEY
+
+
+class Stream(random.Random):
+    # random.Random on top of the keyed hash, so randrange(), shuffle() and
+    # the rest work as usual.
+    def __init__(self, *key):
+        self.key = hashlib.blake2b(repr(key).encode(), key=secret()).digest()
+        super().__init__()
+
+    def seed(self, *args, **kwargs):
+        self.counter = 0
+
+    def block(self):
+        self.counter += 1
+        digest = hashlib.blake2b(self.counter.to_bytes(8, "little"), key=self.key, digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def random(self):
+        return (self.block() >> 11) * 2.0 ** -53
+
+    def getrandbits(self, k):
+        bits = 0
+        for shift in range(0, k, 64):
+            bits |= self.block() << shift
+        return bits & ((1 << k) - 1)
+
+
+def grow_stream(chat_id, user_id, day):
+    # `day` is a date ordinal
+    return Stream("grow", chat_id, user_id, day)
+
+
+def draw_stream(chat_id, day):
+    # pepper of the day, the same for the daily draw and for /pepper_of_the_day
+    return Stream("pepper_of_the_day", chat_id, day)
+
+
+def ball_stream(chat_id, message_id):
+    return Stream("ball", chat_id, message_id)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if len(sys.argv) >= 5 and sys.argv[1] == "grow":
+        from rules import RULES
+
+        chat_id, user_id = int(sys.argv[2]), int(sys.argv[3])
+        day = date.fromisoformat(sys.argv[4]).toordinal()
+        state = dict(zip(("leader", "streak", "place"), sys.argv[5:]))
+        state = {
+            "leader": state.get("leader") == "leader",
+            "streak": int(state.get("streak", 0)),
+            "place": int(state["place"]) if "place" in state else None,
+        }
+        print(RULES.grow(state, grow_stream(chat_id, user_id, day)))
+    elif len(sys.argv) == 5 and sys.argv[1] == "draw":
+        chat_id, participants = int(sys.argv[2]), int(sys.argv[4])
+        draw = draw_stream(chat_id, date.fromisoformat(sys.argv[3]).toordinal()).random()
+        print("draw {}, participant #{}".format(draw, min(int(draw * participants), participants - 1)))
+    else:
+        sys.exit("usage: python rng.py grow <chat_id> <user_id> <YYYY-MM-DD> [leader|-] [streak] [place]\n"
+                 "       python rng.py draw <chat_id> <YYYY-MM-DD> <participants>")
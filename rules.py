@@ -0,0 +1,162 @@
+import json
+import math
+import operator
+import os
+import random
+
+# Game balance as data: the daily growth range and the bonuses, which can be
+# changed with a JSON file in $GAME_RULES instead of code edits.
+#
+# "grow" is the inclusive range of the daily growth. "bonuses" are checked
+# in order and the first one whose conditions all hold replaces the growth
+# with round(growth * multiplier) using its "rounding" (ceil, floor or
+# round). Conditions:
+#   chance       probability that the bonus applies
+#   leader       true/false, the user has the biggest pepper of the chat
+#   min_streak   days in a row the user grew before today, at least
+#   max_streak   ... at most
+#   min_place    place of the pepper before the grow, at least
+#   max_place    ... at most
+# "text" is the line added to the /pepper reply, with the growth as {bonus},
+# and "stats" the /stats line, with the times it applied as {count}. Either
+# is a string or a {locale: string} object (see templates.LOCALE). The
+# bonuses of DEFAULT_RULES have both, a type not among them needs its own.
+# Rules.needs is the state the conditions read. The grow read fetches it
+# together with the pepper row (see queries.GROW_READ), nothing else needs
+# a query of its own.
+#
+# Rules.grow_batch evaluates the rules for arrays of users at once with
+# NumPy, for simulate_rules.py. NumPy is only needed there and isn't in
+# requirements.txt.
+
+DEFAULT_RULES = {
+    "grow": [5, 9],
+    "bonuses": [
+        {
+            "type": "curse_of_the_first",
+            "leader": True,
+            "multiplier": 0.5,
+            "rounding": "ceil",
+            "text": {
+                "ru": '👑 Но из-за "Проклятия первого" рост твоего перчика сегодня уменьшается вдвое до <b>{bonus} см</b>.\n',
+                "en": '👑 But the "Curse of the first" halves the growth of your pepper today to <b>{bonus} cm</b>.\n',
+            },
+            "stats": {
+                "ru": "👑 Проклятие первого: <b>{count}</b> раз\n",
+                "en": "👑 Curse of the first: <b>{count}</b> times\n",
+            },
+        },
+        {
+            "type": "double_increase",
+            "chance": 0.3,
+            "multiplier": 2,
+            "rounding": "round",
+            "text": {
+                "ru": "🍀 А еще ты получаешь бонус с двойным ростом и твой перчик сегодня вырастает на <b>{bonus} см</b>!\n",
+                "en": "🍀 You also get the double growth bonus, your pepper grows by <b>{bonus} cm</b> today!\n",
+            },
+            "stats": {
+                "ru": "🍀 Двойной рост: <b>{count}</b> раз\n",
+                "en": "🍀 Double growth: <b>{count}</b> times\n",
+            },
+        },
+    ],
+}
+# texts of the default bonuses for configs that only change their numbers
+DEFAULT_TEXTS = {rule["type"]: rule for rule in DEFAULT_RULES["bonuses"]}
+# condition: (state it needs, test of the state value against the rule value)
+CONDITIONS = {
+    "leader": ("leader", operator.eq),
+    "min_streak": ("streak", operator.ge),
+    "max_streak": ("streak", operator.le),
+    "min_place": ("place", operator.ge),
+    "max_place": ("place", operator.le),
+}
+ROUNDING = {"ceil": math.ceil, "floor": math.floor, "round": round}
+# the same functions for arrays, np.rint rounds halves to even like round()
+NUMPY_ROUNDING = {"ceil": "ceil", "floor": "floor", "round": "rint"}
+
+
+class Bonus:
+    def __init__(self, rule):
+        rule = dict(rule)
+        self.type = rule.pop("type")
+        self.multiplier = rule.pop("multiplier")
+        self.rounding = rule.pop("rounding", "round")
+        self.chance = rule.pop("chance", None)
+        default = DEFAULT_TEXTS.get(self.type, {})
+        self.text = rule.pop("text", default.get("text"))
+        self.stats = rule.pop("stats", default.get("stats"))
+        for name in ("text", "stats"):
+            if not getattr(self, name):
+                raise ValueError("no {!r} in bonus {}".format(name, self.type))
+        if self.rounding not in ROUNDING:
+            raise ValueError("unknown rounding {!r} in bonus {}".format(self.rounding, self.type))
+        for condition in rule:
+            if condition not in CONDITIONS:
+                raise ValueError("unknown condition {!r} in bonus {}".format(condition, self.type))
+        self.conditions = [
+            (CONDITIONS[condition][0], CONDITIONS[condition][1], value) for condition, value in rule.items()
+        ]
+
+    def applies(self, state, rng):
+        # The chance is drawn whether the conditions hold or not, so a stream
+        # gives the same grows here and in Rules.grow_batch.
+        roll = rng.random() if self.chance is not None else None
+        for name, test, value in self.conditions:
+            # a new pepper has no place yet
+            if state[name] is None or not test(state[name], value):
+                return False
+        return roll is None or roll < self.chance
+
+    def size(self, grow_size):
+        return ROUNDING[self.rounding](grow_size * self.multiplier)
+
+
+class Rules:
+    def __init__(self, config):
+        self.grow_min, self.grow_max = config["grow"]
+        self.bonuses = [Bonus(rule) for rule in config["bonuses"]]
+        self.needs = frozenset(name for bonus in self.bonuses for name, _, _ in bonus.conditions)
+
+    def grow(self, state, rng=random):
+        # {"size": growth, "bonus": None or {"type": ..., "size": growth with the bonus}}
+        # for one user, `state` has the values named in self.needs.
+        grow_size = rng.randrange(self.grow_min, self.grow_max + 1)
+        for bonus in self.bonuses:
+            if bonus.applies(state, rng):
+                return {"size": grow_size, "bonus": {"type": bonus.type, "size": bonus.size(grow_size)}}
+        return {"size": grow_size, "bonus": None}
+
+    def grow_batch(self, state, count, rng):
+        # grow() for `count` users at once. `state` maps the names in
+        # self.needs to arrays, `rng` is a numpy.random.Generator. Returns
+        # the growth with bonuses and the index of the bonus in self.bonuses
+        # (-1 for none) as arrays.
+        import numpy as np
+
+        grow_size = rng.integers(self.grow_min, self.grow_max + 1, count)
+        growth = grow_size.copy()
+        bonus = np.full(count, -1)
+        undecided = np.ones(count, dtype=bool)
+        for index, rule in enumerate(self.bonuses):
+            applies = undecided.copy()
+            for name, test, value in rule.conditions:
+                applies &= test(state[name], value)
+            if rule.chance is not None:
+                applies &= rng.random(count) < rule.chance
+            rounding = getattr(np, NUMPY_ROUNDING[rule.rounding])
+            growth[applies] = rounding(grow_size[applies] * rule.multiplier)
+            bonus[applies] = index
+            undecided &= ~applies
+        return growth, bonus
+
+
+def load_rules(path=None):
+    if not path:
+        return Rules(DEFAULT_RULES)
+    with open(path) as f:
+        return Rules(json.load(f))
+
+
+RULES = load_rules(os.getenv("GAME_RULES"))
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import sys
+from itertools import groupby
+from telebot import asyncio_helper, types
+import tracing
+from cache import TTLCache
+from main import get_command, guard, parse_command_update
+from main_async import bot, handler_error, send_peppers
+
+# Long-running entry point that handles updates in micro-batches instead of
+# one Cloud Function invocation per update:
+#   python server.py polling   # getUpdates long polling
+#   python server.py webhook   # aiohttp webhook on $PORT at $WEBHOOK_PATH
+# Updates collected within BATCH_WINDOW seconds are grouped by chat. The
+# commands of a chat run in the order they came, consecutive /pepper
+# commands share one read and one upsert (see main_async.grow_peppers_batch),
+# and different chats are handled concurrently.
+# Updates are acknowledged before they are handled, so when a command fails
+# it and the later commands of its chat are forgotten by the guard and put
+# back into the queue, up to MAX_RETRIES times.
+# getUpdates doesn't work while a webhook is set, delete it before polling.
+
+logger = logging.getLogger("server")
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", "0.2"))
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+POLLING_TIMEOUT = 30
+MAX_RETRIES = 3
+RETRY_DELAY = 1
+# update_id: times it was put back into the queue
+retries = TTLCache(maxsize=10000, ttl=3600)
+# batches still being handled, so the tasks aren't garbage collected
+running = set()
+
+
+async def process_batch(updates, queue):
+    tracing.start("batch")
+    tracing.annotate(updates=len(updates))
+    try:
+        chats = {}
+        for update in updates:
+            command = get_command(update)
+            if command is not None and guard.admit(update, command):
+                chats.setdefault(update["message"]["chat"]["id"], []).append((command, update))
+        tracing.annotate(chats=len(chats))
+        results = await asyncio.gather(*(process_chat(commands) for commands in chats.values()))
+        for failed in results:
+            for command, update in failed:
+                retry(queue, update, command)
+    finally:
+        tracing.finish()
+
+
+def retry(queue, update, command):
+    guard.forget(update, command)
+    attempts = (retries.get(update["update_id"]) or 0) + 1
+    if attempts > MAX_RETRIES:
+        logger.error("dropping update %s after %s retries", update["update_id"], MAX_RETRIES)
+        return
+    retries.set(update["update_id"], attempts)
+    asyncio.get_running_loop().call_later(RETRY_DELAY, queue.put_nowait, update)
+
+
+async def process_chat(commands):
+    # Returns the commands that weren't handled: the one that failed and
+    # the ones after it.
+    state = {"error": None}
+    handler_error.set(state)
+    done = 0
+    try:
+        for is_pepper, run in groupby(commands, key=lambda pair: pair[0] == "pepper"):
+            run = list(run)
+            if is_pepper:
+                await send_peppers([types.Update.de_json(update).message for _, update in run])
+                done += len(run)
+                continue
+            for _, update in run:
+                await bot.process_new_updates([types.Update.de_json(update)])
+                if state["error"] is not None:
+                    raise state["error"]
+                done += 1
+    except Exception:
+        logger.exception("chat %s failed", commands[0][1]["message"]["chat"]["id"])
+        return commands[done:]
+    return []
+
+
+async def batcher(queue):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        deadline = loop.time() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        task = asyncio.create_task(process_batch(batch, queue))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+
+async def poll(queue):
+    offset = None
+    while True:
+        try:
+            updates = await asyncio_helper.get_updates(
+                bot.token,
+                offset=offset,
+                limit=BATCH_SIZE,
+                timeout=POLLING_TIMEOUT,
+                allowed_updates=["message"],
+                request_timeout=POLLING_TIMEOUT + 10,
+            )
+        except Exception:
+            logger.exception("getUpdates failed")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            queue.put_nowait(update)
+
+
+async def run_polling():
+    queue = asyncio.Queue()
+    await asyncio.gather(poll(queue), batcher(queue))
+
+
+def create_app():
+    from aiohttp import web
+
+    queue = asyncio.Queue()
+
+    async def webhook(request):
+        # answer right away, the update is handled with the next batch
+        update = parse_command_update(await request.text())
+        if update is not None:
+            queue.put_nowait(update)
+        return web.Response(status=200)
+
+    async def start_batcher(app):
+        app["batcher"] = asyncio.create_task(batcher(queue))
+
+    async def stop_batcher(app):
+        app["batcher"].cancel()
+
+    app = web.Application()
+    app.router.add_post(os.getenv("WEBHOOK_PATH", "/"), webhook)
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    mode = sys.argv[1] if len(sys.argv) > 1 else "polling"
+    if mode == "polling":
+        asyncio.run(run_polling())
+    elif mode == "webhook":
+        from aiohttp import web
+
+        web.run_app(create_app(), port=int(os.getenv("PORT", "8080")))
+    else:
+        sys.exit("usage: python server.py [polling|webhook]")
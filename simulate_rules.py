@@ -0,0 +1,85 @@
+import argparse
+import time
+from rules import RULES, load_rules
+
+# Balancing runs for the game rules (rules.py): simulates every user of
+# every chat for a number of days with Rules.grow_batch and prints how the
+# peppers and bonuses come out. Needs numpy (pip install numpy):
+#   python simulate_rules.py --chats 1000 --users 20 --days 365
+#   python simulate_rules.py --rules new_balance.json
+# Each day a user grows with probability --activity.
+
+
+def simulate(rules, chats, users, days, activity, seed):
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    sizes = np.zeros((chats, users), dtype=np.int64)
+    streaks = np.zeros((chats, users), dtype=np.int64)
+    bonuses = np.zeros(len(rules.bonuses) + 1, dtype=np.int64)
+    leaders = np.full(chats, -1)
+    leader_changes = 0
+    grows = 0
+    total_growth = 0
+    for _ in range(days):
+        active = rng.random((chats, users)) < activity
+        exists = sizes > 0
+        leader = sizes.argmax(axis=1)
+        state = {}
+        if "leader" in rules.needs:
+            is_leader = np.zeros((chats, users), dtype=bool)
+            is_leader[np.arange(chats), leader] = exists.any(axis=1)
+            state["leader"] = is_leader[active]
+        if "streak" in rules.needs:
+            state["streak"] = streaks[active]
+        if "place" in rules.needs:
+            # a new pepper has no place, NaN fails every comparison
+            place = (sizes[:, None, :] > sizes[:, :, None]).sum(axis=2) + 1.0
+            state["place"] = np.where(exists, place, np.nan)[active]
+        count = int(active.sum())
+        growth, bonus = rules.grow_batch(state, count, rng)
+        sizes[active] += growth
+        streaks = np.where(active, streaks + 1, 0)
+        bonuses += np.bincount(bonus + 1, minlength=len(bonuses))
+        grows += count
+        total_growth += int(growth.sum())
+        leader = np.where(sizes.any(axis=1), sizes.argmax(axis=1), -1)
+        leader_changes += int(((leader != leaders) & (leaders >= 0)).sum())
+        leaders = leader
+    return {
+        "sizes": sizes,
+        "grows": grows,
+        "total_growth": total_growth,
+        "bonuses": dict(zip(["none"] + [bonus.type for bonus in rules.bonuses], bonuses.tolist())),
+        "leader_changes": leader_changes,
+    }
+
+
+def report(result, chats, days, elapsed):
+    import numpy as np
+
+    sizes = result["sizes"]
+    print("user-days: {} in {:.2f}s ({:.0f}/s)".format(result["grows"], elapsed, result["grows"] / elapsed))
+    print("growth per grow: {:.2f} cm".format(result["total_growth"] / max(result["grows"], 1)))
+    for name, count in result["bonuses"].items():
+        print("{:<24} {:>12} {:>8.2%}".format(name, count, count / max(result["grows"], 1)))
+    percentiles = np.percentile(sizes, [50, 90, 99])
+    print("size p50/p90/p99/max: {:.0f} / {:.0f} / {:.0f} / {}".format(*percentiles, sizes.max()))
+    leader_share = sizes.max(axis=1) / np.maximum(sizes.sum(axis=1), 1)
+    print("leader share of the chat total: {:.2%}".format(leader_share.mean()))
+    print("leader changes per chat per 100 days: {:.2f}".format(result["leader_changes"] / chats / days * 100))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20, help="users per chat")
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--activity", type=float, default=0.7, help="probability a user grows on a day")
+    parser.add_argument("--rules", help="JSON rules file, $GAME_RULES or the defaults if not given")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rules = load_rules(args.rules) if args.rules else RULES
+    started = time.perf_counter()
+    result = simulate(rules, args.chats, args.users, args.days, args.activity, args.seed)
+    report(result, args.chats, args.days, time.perf_counter() - started)
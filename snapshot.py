@@ -0,0 +1,260 @@
+import json
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dotenv import load_dotenv
+
+# Snapshots of the game tables for backups, disaster recovery and seeding
+# local benchmarks (benchmark.py --snapshot):
+#   python snapshot.py export backup.snap
+#   python snapshot.py import backup.snap
+# Export streams every table with a scan query, import loads the rows back
+# with parallel BulkUpsert calls.
+#
+# File format: MAGIC, then chunks of up to CHUNK_ROWS rows of one table.
+# A chunk is CHUNK_HEADER (lengths of the table name and of the column
+# list, row count, size of the compressed rows), the table name, its
+# comma-separated columns and the zlib-compressed rows. A row is a bitmask
+# of its NULL columns (one bit per column, in as many bytes as needed)
+# followed by the other values in column order: Int64 and Uint64 as 8
+# bytes, Utf8 as a 4 byte length and the UTF-8 bytes.
+# Columns missing from an older snapshot are left out of the import.
+# Retired columns of older snapshots are read with RETIRED_COLUMNS and
+# converted by upgrade_rows.
+
+MAGIC = b"PEPSNAP1"
+CHUNK_HEADER = struct.Struct("<HHII")
+CHUNK_ROWS = 10000
+IMPORT_WORKERS = 8
+TABLES = {
+    "peppers": (
+        ("chat_id", "Int64"),
+        ("user_id", "Int64"),
+        ("pepper_id", "Utf8"),
+        ("username", "Utf8"),
+        ("size", "Int64"),
+        ("last_updated", "Int64"),
+        ("day", "Int64"),
+    ),
+    "peppers_of_the_day": (
+        ("chat_id", "Int64"),
+        ("user_id", "Int64"),
+        ("last_updated", "Int64"),
+        ("day", "Int64"),
+    ),
+    "chats": (
+        ("chat_id", "Int64"),
+        ("participants", "Uint64"),
+        ("grows", "Int64"),
+        ("total_growth", "Int64"),
+        ("timezone", "Utf8"),
+    ),
+    "chat_participants": (
+        ("chat_id", "Int64"),
+        ("seq", "Uint64"),
+        ("user_id", "Int64"),
+    ),
+    "pepper_stats": (
+        ("chat_id", "Int64"),
+        ("user_id", "Int64"),
+        ("grows", "Int64"),
+        ("total_growth", "Int64"),
+        ("streak", "Int64"),
+        ("best_streak", "Int64"),
+        ("last_day", "Int64"),
+        ("bonuses", "Utf8"),
+    ),
+    "global_top": (
+        ("chat_id", "Int64"),
+        ("user_id", "Int64"),
+        ("username", "Utf8"),
+        ("size", "Int64"),
+    ),
+    "pepper_events": (
+        ("chat_id", "Int64"),
+        ("user_id", "Int64"),
+        ("created_at", "Int64"),
+        ("grow", "Int64"),
+        ("bonus", "Utf8"),
+        ("size", "Int64"),
+    ),
+}
+# pepper_stats had a count column per bonus type before `bonuses`
+RETIRED_COLUMNS = {
+    "pepper_stats": (("double_increase", "Int64"), ("curse_of_the_first", "Int64")),
+}
+INTEGERS = {"Int64": struct.Struct("<q"), "Uint64": struct.Struct("<Q")}
+LENGTH = struct.Struct("<I")
+
+
+def nulls_size(columns):
+    # bytes of a row's NULL bitmask, one bit per column
+    return (len(columns) + 7) // 8
+
+
+def encode_rows(columns, rows):
+    data = bytearray()
+    size = nulls_size(columns)
+    for row in rows:
+        values = [row[name] for name, _ in columns]
+        data += sum(1 << i for i, value in enumerate(values) if value is None).to_bytes(size, "little")
+        for (_, kind), value in zip(columns, values):
+            if value is None:
+                continue
+            if kind == "Utf8":
+                encoded = value.encode()
+                data += LENGTH.pack(len(encoded))
+                data += encoded
+            else:
+                data += INTEGERS[kind].pack(value)
+    return bytes(data)
+
+
+def decode_rows(columns, data, count):
+    rows = []
+    offset = 0
+    size = nulls_size(columns)
+    for _ in range(count):
+        nulls = int.from_bytes(data[offset:offset + size], "little")
+        offset += size
+        row = {}
+        for i, (name, kind) in enumerate(columns):
+            if nulls & (1 << i):
+                row[name] = None
+            elif kind == "Utf8":
+                (length,) = LENGTH.unpack_from(data, offset)
+                offset += LENGTH.size
+                row[name] = data[offset:offset + length].decode()
+                offset += length
+            else:
+                (row[name],) = INTEGERS[kind].unpack_from(data, offset)
+                offset += INTEGERS[kind].size
+        rows.append(row)
+    return rows
+
+
+def write_chunk(f, table, rows):
+    columns = TABLES[table]
+    compressed = zlib.compress(encode_rows(columns, rows))
+    name = table.encode()
+    names = ",".join(column for column, _ in columns).encode()
+    f.write(CHUNK_HEADER.pack(len(name), len(names), len(rows), len(compressed)))
+    f.write(name)
+    f.write(names)
+    f.write(compressed)
+
+
+def write_snapshot(f, table, rows):
+    # Writes an iterable of rows (dicts or YDB rows) as chunks of `table`.
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_ROWS:
+            write_chunk(f, table, chunk)
+            chunk = []
+    if chunk:
+        write_chunk(f, table, chunk)
+
+
+def read_snapshot(path):
+    # Yields (table, rows) one chunk at a time.
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a snapshot".format(path))
+        while True:
+            header = f.read(CHUNK_HEADER.size)
+            if not header:
+                return
+            name_length, names_length, count, size = CHUNK_HEADER.unpack(header)
+            table = f.read(name_length).decode()
+            kinds = dict(TABLES[table] + RETIRED_COLUMNS.get(table, ()))
+            columns = [(name, kinds[name]) for name in f.read(names_length).decode().split(",")]
+            yield table, upgrade_rows(table, decode_rows(columns, zlib.decompress(f.read(size)), count))
+
+
+def upgrade_rows(table, rows):
+    retired = [name for name, _ in RETIRED_COLUMNS.get(table, ()) if rows and name in rows[0]]
+    if not retired:
+        return rows
+    for row in rows:
+        counts = {name: row.pop(name) for name in retired}
+        row["bonuses"] = json.dumps({name: count for name, count in counts.items() if count}, sort_keys=True)
+    return rows
+
+
+def table_path(name):
+    return "{}/{}".format(os.getenv("YDB_DATABASE"), name)
+
+
+def export_snapshot(driver, path):
+    import ydb
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        for table, columns in TABLES.items():
+            query = "SELECT {} FROM `{}`;".format(", ".join(name for name, _ in columns), table)
+            rows = (
+                row
+                for response in driver.table_client.scan_query(ydb.ScanQuery(query, {}))
+                for row in response.result_set.rows
+            )
+            try:
+                write_snapshot(f, table, rows)
+            except ydb.SchemeError:
+                print("{} doesn't exist, skipped".format(table))
+                continue
+            print("exported {}".format(table))
+
+
+def import_snapshot(driver, path):
+    import ydb
+
+    def column_types(table, names):
+        types = ydb.BulkUpsertColumns()
+        for name, kind in TABLES[table]:
+            if name in names:
+                types.add_column(name, ydb.OptionalType(getattr(ydb.PrimitiveType, kind)))
+        return types
+
+    counts = {}
+    pending = set()
+    with ThreadPoolExecutor(max_workers=IMPORT_WORKERS) as executor:
+        for table, rows in read_snapshot(path):
+            # keep a bounded number of chunks in memory
+            if len(pending) >= IMPORT_WORKERS * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(
+                driver.table_client.bulk_upsert, table_path(table), rows, column_types(table, rows[0])
+            ))
+            counts[table] = counts.get(table, 0) + len(rows)
+        for future in wait(pending).done:
+            future.result()
+    for table, count in counts.items():
+        print("imported {} rows into {}".format(count, table))
+
+
+def run(command, path):
+    import ydb
+    import ydb.iam
+
+    load_dotenv()
+    with ydb.Driver(
+        endpoint=os.getenv("YDB_ENDPOINT"),
+        database=os.getenv("YDB_DATABASE"),
+        credentials=ydb.iam.ServiceAccountCredentials.from_file(os.getenv("SA_KEY_FILE")),
+    ) as driver:
+        driver.wait(timeout=5, fail_fast=True)
+        if command == "export":
+            export_snapshot(driver, path)
+        else:
+            import_snapshot(driver, path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ("export", "import"):
+        sys.exit("usage: python snapshot.py export|import <file>")
+    run(sys.argv[1], sys.argv[2])
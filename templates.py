@@ -0,0 +1,248 @@
+import os
+from html import escape
+from operator import itemgetter
+from string import Formatter
+from rules import RULES
+
+# Reply texts of the bot. Every variant, including the /pepper replies put
+# together from several catalog entries, is compiled once at import into a
+# function that renders it with a single %-format. Field values are
+# HTML-escaped here and nowhere else, the texts themselves are HTML for
+# parse_mode="HTML".
+# BOT_LOCALE picks the catalog, keys missing from it come from DEFAULT_LOCALE.
+
+DEFAULT_LOCALE = "ru"
+LOCALE = os.getenv("BOT_LOCALE", DEFAULT_LOCALE)
+CATALOGS = {
+    "ru": {
+        "grew": "@{username}, твой перчик вырос на <b>{grow} см</b>.\n",
+        "unchanged": "@{username}, твой перчик не изменился.\n",
+        "shrunk": "@{username}, твой перчик уменьшился на <b>{grow} см</b>.\n",
+        "repeat": "@{username}, ты уже измерял перчик сегодня.\n",
+        "size_now": "Теперь он равен <b>{size} см</b>.\n",
+        "size_current": "Сейчас он равен <b>{size} см</b>.\n",
+        "place": "Ты занимаешь <b>{place} место</b> в топе.\n",
+        "next_try": "Следующая попытка завтра!",
+        "top_peppers": "Топ 10 перчиков:\n",
+        "global_top": "Глобальный топ 10 перчиков:\n",
+        "top_row": "\n{index}| <b>{username}</b> — <b>{size} см</b>",
+        "pepper_of_the_day": "<b>@{username}</b>, поздравляю! У тебя сегодня самый лучший перчик!",
+        "current_pepper_of_the_day": "По результатам сегодняшнего розыгрыша лучший перчик у <b>{username}</b>!",
+        "no_peppers": "Перчики не найдены в этом чате. Введите /pepper",
+        "no_global_peppers": "Перчики не найдены. Введите /pepper",
+        "stats": (
+            "Статистика <b>@{username}</b>:\n"
+            "Измерений: <b>{grows}</b>\n"
+            "Всего вырос на <b>{total_growth} см</b>\n"
+            "Серия: <b>{streak}</b> дн. подряд, лучшая — <b>{best_streak}</b>\n"
+        ),
+        "no_stats": "Статистика <b>@{username}</b>:\nТы еще не измерял перчик. Введите /pepper\n",
+        "chat_average": "\nСредний перчик в чате: <b>{size} см</b>",
+        "chat_average_grow": "\nСредний рост за раз: <b>{grow} см</b>",
+        "timezone": "Часовой пояс чата: <b>{timezone}</b>, новый день начинается в полночь по нему.\nИзменить: /timezone Europe/Moscow",
+        "timezone_set": "Теперь часовой пояс чата <b>{timezone}</b>.",
+        "timezone_unknown": "Не знаю часовой пояс <b>{timezone}</b>. Укажите его из базы IANA, например /timezone Europe/Moscow",
+        "timezone_admins_only": "Часовой пояс чата могут менять только администраторы.",
+        # Magic 8 ball answers for /ball
+        "ball": (
+            "Бесспорно",
+            "Предрешено",
+            "Никаких сомнений",
+            "Определённо да",
+            "Можешь быть уверен в этом",
+            "Мне кажется — «да»",
+            "Вероятнее всего",
+            "Хорошие перспективы",
+            "Знаки говорят — «да»",
+            "Пока не ясно, попробуй снова",
+            "Спроси позже",
+            "Лучше не рассказывать",
+            "Сейчас нельзя предсказать",
+            "Сконцентрируйся и спроси опять",
+            "Даже не думай",
+            "Мой ответ — «нет»",
+            "По моим данным — «нет»",
+            "Перспективы не очень хорошие",
+            "Весьма сомнительно",
+        ),
+    },
+    "en": {
+        "grew": "@{username}, your pepper grew by <b>{grow} cm</b>.\n",
+        "unchanged": "@{username}, your pepper didn't change.\n",
+        "shrunk": "@{username}, your pepper shrank by <b>{grow} cm</b>.\n",
+        "repeat": "@{username}, you have already measured your pepper today.\n",
+        "size_now": "Now it is <b>{size} cm</b>.\n",
+        "size_current": "It is <b>{size} cm</b>.\n",
+        "place": "You take <b>place {place}</b> in the top.\n",
+        "next_try": "Next try tomorrow!",
+        "top_peppers": "Top 10 peppers:\n",
+        "global_top": "Global top 10 peppers:\n",
+        "top_row": "\n{index}| <b>{username}</b> — <b>{size} cm</b>",
+        "pepper_of_the_day": "<b>@{username}</b>, congratulations! You have the best pepper today!",
+        "current_pepper_of_the_day": "Today's draw says the best pepper belongs to <b>{username}</b>!",
+        "no_peppers": "No peppers in this chat yet. Send /pepper",
+        "no_global_peppers": "No peppers yet. Send /pepper",
+        "stats": (
+            "Stats of <b>@{username}</b>:\n"
+            "Measurements: <b>{grows}</b>\n"
+            "Grew by <b>{total_growth} cm</b> in total\n"
+            "Streak: <b>{streak}</b> days in a row, best — <b>{best_streak}</b>\n"
+        ),
+        "no_stats": "Stats of <b>@{username}</b>:\nYou haven't measured your pepper yet. Send /pepper\n",
+        "chat_average": "\nAverage pepper in the chat: <b>{size} cm</b>",
+        "chat_average_grow": "\nAverage growth per measurement: <b>{grow} cm</b>",
+        "timezone": "Chat timezone: <b>{timezone}</b>, a new day starts at midnight there.\nChange it: /timezone Europe/London",
+        "timezone_set": "The chat timezone is <b>{timezone}</b> now.",
+        "timezone_unknown": "Unknown timezone <b>{timezone}</b>. Use a name from the IANA database, e.g. /timezone Europe/London",
+        "timezone_admins_only": "Only admins can change the chat timezone.",
+        "ball": (
+            "It is certain",
+            "It is decidedly so",
+            "Without a doubt",
+            "Yes definitely",
+            "You may rely on it",
+            "As I see it, yes",
+            "Most likely",
+            "Outlook good",
+            "Signs point to yes",
+            "Reply hazy, try again",
+            "Ask again later",
+            "Better not tell you now",
+            "Cannot predict now",
+            "Concentrate and ask again",
+            "Don't count on it",
+            "My reply is no",
+            "My sources say no",
+            "Outlook not so good",
+            "Very doubtful",
+        ),
+    },
+}
+# fields filled in with text sent by users, everything else is numbers
+USER_FIELDS = {"username", "timezone"}
+# /pepper replies, each one compiled from these catalog entries. Every bonus
+# of rules.RULES adds "pepper_<type>", BONUS_VARIANT with the bonus text as
+# "bonus", and "bonus_stats_<type>", its /stats line.
+BONUS_VARIANT = ("grew", "bonus", "size_now", "place", "next_try")
+ROW_FIELDS = ("index", "username", "size")
+PEPPER_VARIANTS = {
+    "pepper_grew": ("grew", "size_now", "place", "next_try"),
+    "pepper_unchanged": ("unchanged", "size_now", "place", "next_try"),
+    "pepper_shrunk": ("shrunk", "size_now", "place", "next_try"),
+    "pepper_repeat": ("repeat", "size_current", "place", "next_try"),
+}
+
+
+def compile_template(text):
+    # A function of the field values. Plain {name} fields are picked out of
+    # the values by one itemgetter and %-formatted into the text, the rest
+    # ({0}, {user.name}, format specs) go through the lookups str.format
+    # does. Values for fields the text doesn't use are ignored.
+    pieces = list(Formatter().parse(text))
+    if any(field is not None and not (field.isidentifier() and not spec and not conversion)
+           for _, field, spec, conversion in pieces):
+        return compile_fields(pieces)
+    template = "".join(literal.replace("%", "%%") + ("%s" if field is not None else "")
+                       for literal, field, _, _ in pieces)
+    fields = [field for _, field, _, _ in pieces if field is not None]
+    quoted = [field for field in dict.fromkeys(fields) if field in USER_FIELDS]
+    if not fields:
+        text = template % ()
+        return lambda **_: text
+    if len(fields) == 1:
+        (field,) = fields
+        convert = quote if quoted else str
+        return lambda **values: template % (convert(values[field]),)
+    get = itemgetter(*fields)
+    if not quoted:
+        return lambda **values: template % get(values)
+
+    def render(**values):
+        for field in quoted:
+            value = values[field]
+            # quote() inlined for the usual plain username
+            if value.__class__ is not str or "<" in value or ">" in value or "&" in value:
+                values[field] = quote(value)
+        return template % get(values)
+    return render
+
+
+def compile_row(text):
+    # The /top_peppers row as a %-format of (index, username, size), None if
+    # the catalog's row has other fields or another order.
+    pieces = list(Formatter().parse(text))
+    fields = [(field, spec, conversion) for _, field, spec, conversion in pieces if field is not None]
+    if fields != [(field, "", None) for field in ROW_FIELDS]:
+        return None
+    return "".join(literal.replace("%", "%%") + ("%s" if field is not None else "")
+                   for literal, field, _, _ in pieces)
+
+
+def compile_fields(pieces):
+    formatter = Formatter()
+
+    def render(*args, **values):
+        result = []
+        for literal, field, spec, conversion in pieces:
+            result.append(literal)
+            if field is not None:
+                value, name = formatter.get_field(field, args, values)
+                value = formatter.format_field(formatter.convert_field(value, conversion), spec or "")
+                result.append(quote(value) if name in USER_FIELDS else value)
+        return "".join(result)
+    return render
+
+
+def quote(value):
+    # the only place where user text goes into a reply
+    value = str(value)
+    if "<" in value or ">" in value or "&" in value:
+        return escape(value, quote=False)
+    return value
+
+
+def compile_catalog(locale, bonuses=RULES.bonuses):
+    catalog = dict(CATALOGS[DEFAULT_LOCALE], **CATALOGS.get(locale, {}))
+    templates = {key: compile_template(text) for key, text in catalog.items() if isinstance(text, str)}
+    for variant, keys in PEPPER_VARIANTS.items():
+        templates[variant] = compile_template("".join(catalog[key] for key in keys))
+    for bonus in bonuses:
+        texts = dict(catalog, bonus=localize(bonus.text, locale))
+        templates["pepper_" + bonus.type] = compile_template("".join(texts[key] for key in BONUS_VARIANT))
+        templates["bonus_stats_" + bonus.type] = compile_template(localize(bonus.stats, locale))
+    return templates, list(catalog["ball"]), compile_row(catalog["top_row"])
+
+
+def localize(text, locale):
+    # a text of the rules config, one string or one per locale
+    if isinstance(text, str):
+        return text
+    return text.get(locale) or text.get(DEFAULT_LOCALE) or next(iter(text.values()))
+
+
+TEMPLATES, BALL_RESPONSES, TOP_ROW = compile_catalog(LOCALE)
+
+
+def render(key, **values):
+    return TEMPLATES[key](**values)
+
+
+def render_many(parts):
+    # (key, values) pairs rendered into one text
+    return "".join([TEMPLATES[key](**values) for key, values in parts])
+
+
+def render_top(key, peppers):
+    # a header and a numbered row for each pepper
+    if TOP_ROW is None:
+        row = TEMPLATES["top_row"]
+        rows = [
+            row(index=index, username=pepper.username, size=pepper.size)
+            for index, pepper in enumerate(peppers, start=1)
+        ]
+        return TEMPLATES[key]() + "".join(rows)
+    # all rows in one %-format of the row repeated
+    values = []
+    for index, pepper in enumerate(peppers, start=1):
+        values += (index, quote(pepper.username), pepper.size)
+    return TEMPLATES[key]() + (TOP_ROW * len(peppers)) % tuple(values)
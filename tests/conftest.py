@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules live in the repository root, main.py needs a token to import.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("TELEGRAM_TOKEN", "0:test")
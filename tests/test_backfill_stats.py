@@ -0,0 +1,89 @@
+import os
+import pytest
+
+# Runs create_table.py add_stats against a scratch YDB database, its tables
+# are dropped and created again:
+#   YDB_TEST_ENDPOINT=grpc://localhost:2136 YDB_TEST_DATABASE=/local pytest tests
+pytestmark = pytest.mark.skipif(
+    not os.getenv("YDB_TEST_ENDPOINT"), reason="needs a scratch database in $YDB_TEST_ENDPOINT"
+)
+TABLES = ("peppers", "peppers_of_the_day", "outbox", "chats", "chat_participants", "pepper_events", "pepper_stats", "global_top")
+
+
+@pytest.fixture
+def database(monkeypatch):
+    import ydb
+    import create_table
+    import repository
+
+    monkeypatch.setenv("YDB_DATABASE", os.getenv("YDB_TEST_DATABASE", "/local"))
+    driver = ydb.Driver(
+        endpoint=os.getenv("YDB_TEST_ENDPOINT"),
+        database=os.getenv("YDB_DATABASE"),
+        credentials=ydb.AnonymousCredentials(),
+    )
+    driver.wait(timeout=5, fail_fast=True)
+    pool = ydb.SessionPool(driver)
+
+    def reset(session):
+        for table in TABLES:
+            try:
+                session.drop_table(create_table.table_path(table))
+            except ydb.SchemeError:
+                pass
+
+    pool.retry_operation_sync(reset)
+    create_table.create_tables(driver, pool)
+    monkeypatch.setattr(repository, "get_pool", lambda: pool)
+    yield driver, pool
+    pool.stop()
+    driver.stop()
+
+
+def execute(pool, query):
+    def callee(session):
+        return session.transaction().execute(query, commit_tx=True)
+
+    return pool.retry_operation_sync(callee)
+
+
+def chat(pool, chat_id):
+    return execute(pool, "SELECT grows, total_growth FROM `chats` WHERE chat_id = {};".format(chat_id))[0].rows[0]
+
+
+def user_stats(pool, chat_id, user_id):
+    query = "SELECT grows, total_growth FROM `pepper_stats` WHERE chat_id = {} AND user_id = {};"
+    return execute(pool, query.format(chat_id, user_id))[0].rows[0]
+
+
+def test_backfill_twice_around_a_grow(database):
+    import create_table
+    import repository
+
+    driver, pool = database
+    execute(
+        pool,
+        """
+        UPSERT INTO `peppers` (chat_id, user_id, pepper_id, username, size, last_updated) VALUES
+            (-1, 1, "a", "user1", 10, 0),
+            (-1, 2, "b", "user2", 20, 0);
+        """,
+    )
+    create_table.add_stats(driver, pool)
+    assert (chat(pool, -1).grows, chat(pool, -1).total_growth) == (None, 30)
+
+    result = repository.grow_pepper_transaction(-1, 1, "user1")
+    create_table.add_stats(driver, pool)
+    # the grow is counted, the rerun keeps it and the unknown count
+    assert (chat(pool, -1).grows, chat(pool, -1).total_growth) == (None, 20 + result["size"])
+    assert (user_stats(pool, -1, 1).grows, user_stats(pool, -1, 1).total_growth) == (1, result["size"])
+
+
+def test_backfill_keeps_counted_grows(database):
+    import create_table
+    import repository
+
+    driver, pool = database
+    result = repository.grow_pepper_transaction(-2, 1, "user1")
+    create_table.add_stats(driver, pool)
+    assert (chat(pool, -2).grows, chat(pool, -2).total_growth) == (1, result["size"])
@@ -0,0 +1,51 @@
+from rng import Stream, ball_stream, draw_stream, grow_stream
+
+
+def values(stream):
+    return [stream.random(), stream.randrange(5, 10), stream.getrandbits(100)]
+
+
+def test_same_key_and_inputs_give_the_same_draws(monkeypatch):
+    monkeypatch.setenv("RNG_KEY", "test")
+    assert values(grow_stream(-1, 2, 740000)) == values(grow_stream(-1, 2, 740000))
+    assert values(draw_stream(-1, 740000)) == values(draw_stream(-1, 740000))
+    assert values(ball_stream(-1, 7)) == values(ball_stream(-1, 7))
+    candidates = list(range(20))
+    shuffled = list(candidates)
+    draw_stream(-1, 740000).shuffle(shuffled)
+    again = list(candidates)
+    draw_stream(-1, 740000).shuffle(again)
+    assert shuffled == again
+
+
+def test_rng_key_changes_the_draws(monkeypatch):
+    monkeypatch.setenv("RNG_KEY", "test")
+    before = values(grow_stream(-1, 2, 740000))
+    monkeypatch.setenv("RNG_KEY", "other")
+    assert values(grow_stream(-1, 2, 740000)) != before
+
+
+def test_stream_keys_are_separate(monkeypatch):
+    monkeypatch.setenv("RNG_KEY", "test")
+    streams = [
+        grow_stream(-1, 2, 740000),
+        grow_stream(-1, 2, 740001),
+        grow_stream(-1, 3, 740000),
+        grow_stream(-2, 2, 740000),
+        draw_stream(-1, 740000),
+        ball_stream(-1, 740000),
+        # the same values under another purpose
+        Stream("ball", -1, 2, 740000),
+    ]
+    draws = [tuple(values(stream)) for stream in streams]
+    assert len(set(draws)) == len(draws)
+
+
+def test_values_follow_the_counter(monkeypatch):
+    monkeypatch.setenv("RNG_KEY", "test")
+    stream = grow_stream(-1, 2, 740000)
+    first = [stream.random() for _ in range(3)]
+    stream.seed()
+    assert [stream.random() for _ in range(3)] == first
+    assert len(set(first)) == 3
+    assert all(0 <= value < 1 for value in first)
@@ -0,0 +1,74 @@
+import json
+import pytest
+from rng import grow_stream
+from rules import DEFAULT_RULES, Rules, load_rules
+
+# Bonuses with chances behind conditions, where the order of the draws
+# matters, on top of the defaults.
+CONFIG = {
+    "grow": [-2, 9],
+    "bonuses": [
+        {"type": "comeback", "max_place": 2, "chance": 0.5, "multiplier": 3, "rounding": "floor", "text": "{bonus}", "stats": "{count}"},
+        {"type": "streak", "min_streak": 3, "chance": 0.4, "multiplier": 1.5, "text": "{bonus}", "stats": "{count}"},
+    ] + DEFAULT_RULES["bonuses"],
+}
+STATES = [
+    {"leader": leader, "streak": streak, "place": place}
+    for leader in (False, True)
+    for streak in (0, 5)
+    for place in (1, 4)
+]
+
+
+class StreamGenerator:
+    # The numpy.random.Generator methods grow_batch uses, on a rng.Stream.
+    def __init__(self, stream):
+        self.stream = stream
+
+    def integers(self, low, high, count):
+        import numpy as np
+
+        return np.array([self.stream.randrange(low, high) for _ in range(count)])
+
+    def random(self, count):
+        import numpy as np
+
+        return np.array([self.stream.random() for _ in range(count)])
+
+
+@pytest.mark.parametrize("config", [DEFAULT_RULES, CONFIG])
+def test_grow_and_grow_batch_agree(config):
+    # grow_batch needs numpy, which isn't in requirements.txt
+    np = pytest.importorskip("numpy")
+    rules = Rules(config)
+    for user_id in range(50):
+        for state in STATES:
+            grow = rules.grow(state, grow_stream(-1, user_id, 740000))
+            growth, bonus = rules.grow_batch(
+                {name: np.array([value]) for name, value in state.items()},
+                1,
+                StreamGenerator(grow_stream(-1, user_id, 740000)),
+            )
+            expected = grow["bonus"]["size"] if grow["bonus"] else grow["size"]
+            assert growth[0] == expected
+            assert bonus[0] == ([rule.type for rule in rules.bonuses].index(grow["bonus"]["type"]) if grow["bonus"] else -1)
+
+
+def test_grow_is_reproducible():
+    rules = Rules(DEFAULT_RULES)
+    state = {"leader": False, "streak": 0, "place": 3}
+    assert rules.grow(state, grow_stream(-1, 1, 740000)) == rules.grow(state, grow_stream(-1, 1, 740000))
+
+
+def test_load_rules_rejects_bonus_without_text(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"grow": [5, 9], "bonuses": [{"type": "new", "multiplier": 2}]}))
+    with pytest.raises(ValueError, match="new"):
+        load_rules(str(path))
+
+
+def test_default_bonuses_keep_their_texts(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"grow": [1, 2], "bonuses": [{"type": "double_increase", "multiplier": 3}]}))
+    (bonus,) = load_rules(str(path)).bonuses
+    assert bonus.text == DEFAULT_RULES["bonuses"][1]["text"]
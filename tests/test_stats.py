@@ -0,0 +1,27 @@
+import json
+from types import SimpleNamespace
+from repository import bonus_counts, grow_stats
+
+ROW = dict(grows=3, total_growth=20, streak=1, best_streak=2, last_day=9)
+
+
+def test_bonus_counts_of_a_row():
+    assert bonus_counts(None) == {}
+    assert bonus_counts(SimpleNamespace(bonuses='{"streak": 2}', **ROW)) == {"streak": 2}
+
+
+def test_bonus_counts_of_a_row_before_the_bonuses_column():
+    stats = SimpleNamespace(double_increase=2, curse_of_the_first=0, **ROW)
+    assert bonus_counts(stats) == {"double_increase": 2}
+    stats = SimpleNamespace(bonuses=None, double_increase=None, curse_of_the_first=1, **ROW)
+    assert bonus_counts(stats) == {"curse_of_the_first": 1}
+
+
+def test_grow_stats_counts_the_bonus_by_type():
+    stats = SimpleNamespace(double_increase=2, curse_of_the_first=0, **ROW)
+    row = grow_stats(stats, -1, 1, {"size": 5, "bonus": {"type": "streak", "size": 10}}, 10)
+    assert json.loads(row["bonuses"]) == {"double_increase": 2, "streak": 1}
+    assert (row["grows"], row["total_growth"], row["streak"], row["best_streak"]) == (4, 30, 2, 2)
+    row = grow_stats(SimpleNamespace(bonuses=row["bonuses"], **dict(ROW, last_day=10)), -1, 1, {"size": 5, "bonus": None}, 12)
+    assert json.loads(row["bonuses"]) == {"double_increase": 2, "streak": 1}
+    assert row["streak"] == 1
@@ -0,0 +1,23 @@
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+import repository
+
+
+@pytest.mark.parametrize("timezone", ["Europe/Moscow", "America/Santiago", "UTC"])
+def test_drawn_timezones_are_valid(timezone):
+    assert repository.valid_timezone(timezone)
+
+
+@pytest.mark.parametrize("timezone", ["right/Europe/Moscow", "posix/Europe/Moscow", "Nope/Nowhere", "../etc/passwd", ""])
+def test_undrawn_timezones_are_invalid(timezone):
+    assert not repository.valid_timezone(timezone)
+
+
+def test_midnight_timezones_are_valid():
+    now = datetime(2026, 9, 6, 4, tzinfo=ZoneInfo("UTC"))
+    names = [timezone for timezone in repository.midnight_timezones(now) if timezone is not None]
+    assert "America/Santiago" in names
+    assert all(repository.valid_timezone(timezone) for timezone in names)
@@ -0,0 +1,185 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-invocation tracing. start() opens a trace for the incoming event,
+# stage() times parts of the handler, the YDB pool and the outbox record
+# their calls into it, and finish() prints everything as one JSON line.
+
+TRACE_HEADERS = ("X-Trace-Id", "Uber-Trace-Id", "X-Request-Id")
+# Longer lists (e.g. the daily draw) are only counted and summed.
+MAX_RECORDS = 50
+
+_current = contextvars.ContextVar("trace", default=None)
+# the TracedPool call that statements executed now belong to
+_current_query = contextvars.ContextVar("query", default=None)
+
+
+class Trace:
+    def __init__(self, name, headers):
+        self.name = name
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.ids = {header: headers[header] for header in TRACE_HEADERS if headers.get(header)}
+        self.fields = {}
+        self.stages = {}
+        self.queries = []
+        self.sends = []
+        self.totals = {"db_calls": 0, "db_ms": 0.0, "telegram_calls": 0, "telegram_ms": 0.0}
+
+    @property
+    def trace_id(self):
+        return self.ids.get("X-Trace-Id") or self.ids.get("Uber-Trace-Id")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "trace": self.name,
+                **self.ids,
+                **self.fields,
+                "total_ms": ms(time.perf_counter() - self.started),
+                "stages_ms": dict(self.stages),
+                **{key: round(value, 3) for key, value in self.totals.items()},
+                "queries": list(self.queries),
+                "sends": list(self.sends),
+            }
+
+
+def ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def start(name, event=None):
+    headers = (event or {}).get("headers") or {}
+    trace = Trace(name, headers)
+    _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def trace_id():
+    trace = _current.get()
+    return trace.trace_id if trace else None
+
+
+def annotate(**fields):
+    trace = _current.get()
+    if trace:
+        with trace.lock:
+            trace.fields.update(fields)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _current.get()
+        if trace:
+            with trace.lock:
+                trace.stages[name] = round(trace.stages.get(name, 0) + ms(time.perf_counter() - started), 3)
+
+
+def record_query(record):
+    trace = _current.get()
+    if trace:
+        with trace.lock:
+            trace.totals["db_calls"] += 1
+            trace.totals["db_ms"] += record["ms"]
+            if len(trace.queries) < MAX_RECORDS:
+                trace.queries.append(record)
+
+
+def record_send(record):
+    trace = _current.get()
+    if trace:
+        with trace.lock:
+            trace.totals["telegram_calls"] += record.get("attempts", 1)
+            trace.totals["telegram_ms"] += record["ms"]
+            if len(trace.sends) < MAX_RECORDS:
+                trace.sends.append(record)
+
+
+def finish():
+    trace = _current.get()
+    if trace is None:
+        return None
+    _current.set(None)
+    line = trace.to_dict()
+    print(json.dumps(line, ensure_ascii=False, default=str))
+    return line
+
+
+class TracedPool:
+    # Wraps a YDB SessionPool. Every retry_operation_sync call is recorded
+    # with the name of the data-access function, its latency, the number
+    # of attempts and the statements it ran (see queries.execute).
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def retry_operation_sync(self, callee, *args, **kwargs):
+        record = {
+            "name": callee.__qualname__.split(".<locals>")[0],
+            "attempts": 0,
+            "statements": [],
+        }
+        token = _current_query.set(record)
+
+        def attempt(session, *args, **kwargs):
+            record["attempts"] += 1
+            return callee(session, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return self.pool.retry_operation_sync(attempt, *args, **kwargs)
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            _current_query.reset(token)
+            _close_record(record, started)
+
+    async def retry_operation(self, callee, *args, **kwargs):
+        # same for ydb.aio.SessionPool
+        record = {
+            "name": callee.__qualname__.split(".<locals>")[0],
+            "attempts": 0,
+            "statements": [],
+        }
+        token = _current_query.set(record)
+
+        async def attempt(session, *args, **kwargs):
+            record["attempts"] += 1
+            return await callee(session, *args, **kwargs)
+
+        started = time.perf_counter()
+        try:
+            return await self.pool.retry_operation(attempt, *args, **kwargs)
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            _current_query.reset(token)
+            _close_record(record, started)
+
+
+def _close_record(record, started):
+    record["ms"] = ms(time.perf_counter() - started)
+    record["retries"] = max(0, record["attempts"] - 1)
+    record["rows"] = sum(statement["rows"] for statement in record["statements"])
+    record_query(record)
+
+
+def record_statement(name, seconds, rows):
+    record = _current_query.get()
+    if record is not None:
+        record["statements"].append({"name": name, "ms": ms(seconds), "rows": rows})